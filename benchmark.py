@@ -0,0 +1,527 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import pagarme_check
+import pagarme_validation
+from extrato import EXTRATO_FOLDER, load_extrato_diario
+from instrumentation import finish_run, paused, stage, start_run
+from pagarme_check import check_chargeback
+
+# Offline benchmark of every reconciliation stage on synthetic Pagar.me data. Tables are generated in a work
+# folder laid out like the real cache (<DATABASE_NAME>_*.feather, extrato_diario/), each stage is timed (best
+# of --repeat, with CPU time and peak RSS from the run report) and memory profiled (tracemalloc peak, in a separate
+# pass) and the results are appended to --output so runs of different commits can be compared. The run report
+# (every pass and the stages nested in it) is saved in RUN_REPORT_FOLDER. --suite parity checks that the DuckDB
+# backend returns the pandas results, on caches synced from a SQLite stand-in of the DB, and --suite reconcile that
+# the incremental reconcile keeps the issues of a full recompute as that DB changes.
+
+BENCHMARK_DATABASE_NAME = 'benchmark'
+BENCHMARK_RESULTS = 'benchmark_results.csv'
+# Share of transactions of each kind and number of installments of a sale
+TRANSACTION_KINDS = {'credit': .70, 'refund': .10, 'chargeback_credit': .04, 'chargeback_refund': .04,
+                     'chargeback_only': .03, 'refund_reversal': .04, 'no_sales': .02, 'value_mismatch': .03}
+INSTALLMENTS = {1: .55, 2: .15, 3: .12, 6: .10, 10: .05, 12: .03}
+
+
+def chargeback_frames(n_transactions, seed=0):
+    # Adjusted payables / sales where ~20% of the transactions have chargebacks
+    rng = np.random.default_rng(seed)
+    ids = pd.Series(np.arange(n_transactions) + 10 ** 8, dtype='Int64')
+    # Amounts in integer cents, as after payables_adjust / sales_adjust
+    valor = rng.integers(1000, 50000, n_transactions)
+    kind = rng.choice(['credit', 'chargeback_credit', 'chargeback_refund', 'chargeback_only', 'refund_only'],
+                      n_transactions, p=[.8, .05, .05, .05, .05])
+    has_credit = kind != 'chargeback_only'
+    has_chargeback = np.isin(kind, ['chargeback_credit', 'chargeback_refund', 'chargeback_only'])
+    has_chargeback_refund = np.isin(kind, ['chargeback_refund', 'refund_only'])
+    df_p = pd.concat([pd.DataFrame({'transaction_id': ids[has_credit], 'installment': 1,
+                                    'valor': valor[has_credit], 'status': 'credit'}),
+                      pd.DataFrame({'transaction_id': ids[has_chargeback], 'installment': 1,
+                                    'valor': -valor[has_chargeback], 'status': 'chargeback'}),
+                      pd.DataFrame({'transaction_id': ids[has_chargeback_refund], 'installment': 1,
+                                    'valor': valor[has_chargeback_refund], 'status': 'chargeback_refund'})],
+                     ignore_index=True)
+    df_p['status'] = df_p['status'].astype('category')
+    df_s = pd.DataFrame({'transaction_id': ids, 'installment': 1, 'valor': valor,
+                         'refund': np.where(has_chargeback & ~has_chargeback_refund, -valor, 0)})
+    return df_p, df_s
+
+
+def bench_chargeback(sizes, repeat=3):
+    # Linear scaling: time per payables row should stay flat as the number of transactions grows
+    results = []
+    for size in sizes:
+        df_p, df_s = chargeback_frames(size)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            check_chargeback(df_p, df_s)
+            timings.append(time.perf_counter() - start)
+        results.append({'transactions': size, 'payables_rows': len(df_p), 'seconds': min(timings),
+                        'us_per_row': min(timings) / len(df_p) * 1e6})
+    return pd.DataFrame(results)
+
+
+def synthetic_tables(n_transactions, seed=0):
+    # Raw payables / transactions / sales as streamed from the DB (PAYABLES_COLUMNS, TRANSACTIONS_COLUMNS,
+    # SALES_COLUMNS), with the credit, refund, chargeback and refund_reversal patterns the checks look for
+    rng = np.random.default_rng(seed)
+    ids = np.arange(n_transactions, dtype='int64') + 10 ** 8
+    kind = rng.choice(list(TRANSACTION_KINDS), n_transactions, p=list(TRANSACTION_KINDS.values()))
+    installments = rng.choice(list(INSTALLMENTS), n_transactions, p=list(INSTALLMENTS.values()))
+    # Installment amounts in cents, sales dated along 2022-12 .. 2023-10 so installments are paid in 2023
+    per_installment = rng.integers(1000, 200000, n_transactions)
+    sold_at = pd.Timestamp('2022-12-01') + pd.to_timedelta(rng.integers(0, 330, n_transactions), unit='D')
+
+    # One row per (transaction, installment)
+    row_tx = np.repeat(np.arange(n_transactions), installments)
+    row_installment = np.arange(len(row_tx)) - np.repeat(np.cumsum(installments) - installments, installments) + 1
+    row_paid_at = sold_at[row_tx] + pd.to_timedelta(30 * row_installment, unit='D')
+    first = row_installment == 1
+
+    def payables(rows, sign, status, days=0):
+        return pd.DataFrame({'transaction_id': ids[row_tx[rows]], 'installment': row_installment[rows],
+                             'amount': sign * per_installment[row_tx[rows]] / 100, 'type': status,
+                             'data_de_competencia': row_paid_at[rows] + pd.Timedelta(days=days)})
+
+    row_kind = kind[row_tx]
+    has_chargeback = np.isin(row_kind, ['chargeback_credit', 'chargeback_refund', 'chargeback_only'])
+    df_payables = pd.concat([
+        payables(row_kind != 'chargeback_only', 1, 'credit'),
+        payables(row_kind == 'refund', -1, 'refund', 10),
+        payables(first & has_chargeback, -1, 'chargeback', 20),
+        payables(first & (row_kind == 'chargeback_refund'), 1, 'chargeback_refund', 40),
+        payables(first & (row_kind == 'refund_reversal'), -1, 'refund', 10),
+        payables(first & (row_kind == 'refund_reversal'), 1, 'refund_reversal', 15),
+    ], ignore_index=True)
+    df_payables = df_payables.iloc[rng.permutation(len(df_payables))].reset_index(drop=True)
+
+    df_transactions = pd.DataFrame({
+        'transaction_id': ids, 'installments': installments,
+        'status': np.where(kind == 'refund', 'refunded', np.where(has_chargeback[first], 'chargedback', 'paid')),
+        'nsu': 5 * 10 ** 8 + rng.permutation(n_transactions)})
+
+    # Sales: every installment, refunds booked on the first one (chargebacks without counterpart too)
+    sales_rows = row_kind != 'no_sales'
+    refunded = np.isin(row_kind, ['refund', 'chargeback_only']) & first
+    refund = np.where(refunded, -per_installment[row_tx] * np.where(row_kind == 'refund', installments[row_tx], 1), 0)
+    valor = per_installment[row_tx] + np.where(row_kind == 'value_mismatch', 100, 0)
+    df_sales = pd.DataFrame({
+        'gateway_id': pd.Series(row_installment).astype(str) + '-' + pd.Series(ids[row_tx]).astype(str),
+        'data_venda': sold_at[row_tx].strftime('%Y-%m-%d'), 'cpf_responsavel_compra': '00000000000',
+        'status': np.where(refunded, 'refunded', 'paid'), 'valor_parcela_total': valor / 100,
+        'valor_total_venda': valor / 100, 'valor_taxa_total': np.round(valor * .03) / 100,
+        'valor_cancelamento': np.where(refunded, refund / 100, np.nan),
+        'reembolso_taxa': np.where(refunded, -np.round(refund * .03) / 100, np.nan), 'juros_atraso': np.nan,
+        'recebimento_financiamento': row_paid_at,
+        'efetivacao_cancelamento': (row_paid_at + pd.Timedelta(days=10)).where(refunded)})[sales_rows]
+    return df_payables, df_transactions, df_sales.reset_index(drop=True)
+
+
+def brl_format(cents):
+    # Integer cents to the statement format: "1.234,56", "-12,30", "-" for zero
+    sign = np.where(cents < 0, '-', '')
+    reais = pd.Series(np.abs(cents) // 100).map('{:,}'.format).str.replace(',', '.')
+    text = sign + reais + ',' + pd.Series(np.abs(cents) % 100).astype(str).str.zfill(2)
+    return text.where(cents != 0, '-')
+
+
+def synthetic_extrato(folder, df_sales, df_transactions):
+    # Daily statement csv files (extrato_diario/YYYY-MM/extrato_YYYY-MM-DD.csv) with the credits and refunds of
+    # the sales, keyed by nsu
+    installment, transaction_id = pd.Series(df_sales['gateway_id']).str.split('-', expand=True).astype('int64').T.values
+    nsu = pd.Series(df_transactions['nsu'].to_numpy(), index=df_transactions['transaction_id']).\
+        reindex(transaction_id).to_numpy()
+    valor = np.round(df_sales['valor_parcela_total'].to_numpy() * 100).astype('int64')
+    refund = np.round(df_sales['valor_cancelamento'].fillna(0).to_numpy() * 100).astype('int64')
+    credits = pd.DataFrame({'paid_at': df_sales['recebimento_financiamento'].to_numpy(), 'nsu': nsu,
+                            'installment': installment, 'entrada': valor, 'saida': 0,
+                            'taxa': -np.round(valor * .03).astype('int64'), 'tipo': 'Pagamento'})
+    refunded = refund != 0
+    refunds = pd.DataFrame({'paid_at': df_sales['efetivacao_cancelamento'].to_numpy()[refunded], 'nsu': nsu[refunded],
+                            'installment': installment[refunded], 'entrada': 0, 'saida': refund[refunded],
+                            'taxa': np.round(refund[refunded] * .03).astype('int64'), 'tipo': 'Estorno'})
+    df = pd.concat([credits, refunds], ignore_index=True)
+    df = df[df['nsu'].notna()]
+    df_csv = pd.DataFrame({
+        'Data de pagamento': pd.to_datetime(df['paid_at']).dt.strftime('%d/%m/%Y %H:%M').to_numpy(),
+        'Data de criação': pd.to_datetime(df['paid_at']).dt.strftime('%d/%m/%Y %H:%M').to_numpy(),
+        'ID da Transação': df['nsu'].astype('int64').to_numpy(),
+        'Parcela': df['installment'].astype(str).to_numpy(),
+        'Tipo da operação': df['tipo'].to_numpy(),
+        'Entrada': brl_format(df['entrada'].to_numpy()).to_numpy(),
+        'Saída': brl_format(df['saida'].to_numpy()).to_numpy(),
+        'Taxa total da operação': brl_format(df['taxa'].to_numpy()).to_numpy(),
+        'Descrição': 'Cartão de crédito'})
+    for day, df_day in df_csv.groupby(pd.to_datetime(df['paid_at']).dt.strftime('%Y-%m-%d').to_numpy()):
+        month_folder = os.path.join(folder, day[:7])
+        os.makedirs(month_folder, exist_ok=True)
+        df_day.to_csv(os.path.join(month_folder, 'extrato_' + day + '.csv'), index=False)
+
+
+def prepare_workdir(workdir, n_transactions, seed=0):
+    # Generated once per size: later runs with the same --workdir reuse the files
+    size_folder = os.path.join(workdir, 'n' + str(n_transactions))
+    os.makedirs(size_folder, exist_ok=True)
+    os.chdir(size_folder)
+    if not os.path.exists(pagarme_check.local_df_path('pagarme_sales')):
+        df_payables, df_transactions, df_sales = synthetic_tables(n_transactions, seed)
+        synthetic_extrato(EXTRATO_FOLDER, df_sales, df_transactions)
+        pagarme_check.local_df_save({'pagarme_payables': df_payables, 'pagarme_transactions': df_transactions,
+                                     'pagarme_sales': df_sales})
+        # adjust_transactions reads the transactions of the main DB
+        df_transactions.to_feather("faturamento_pagarme_transactions.feather")
+    return pagarme_check.local_df_load(['pagarme_payables', 'pagarme_transactions', 'pagarme_sales'])
+
+
+def benchmark_stages(df_payables, df_transactions, df_sales):
+    # Stage name -> (setup returning the arguments, stage function). Setups copy the inputs since the adjust
+    # functions change their argument, and run outside the measurements
+    df_p = pagarme_check.payables_adjust(df_payables.copy())
+    df_t = pagarme_check.transactions_adjust(df_transactions.copy())
+    df_s = pagarme_check.sales_adjust(df_sales.copy())
+    return {
+        'payables_adjust': (lambda: (df_payables.copy(),), pagarme_check.payables_adjust),
+        'sales_adjust': (lambda: (df_sales.copy(),), pagarme_check.sales_adjust),
+        'transactions_adjust': (lambda: (df_transactions.copy(),), pagarme_check.transactions_adjust),
+        'check_single_occurancy': (lambda: (df_p, df_t, df_s), pagarme_check.check_single_occurancy),
+        'check_refund': (lambda: (df_p, df_s), pagarme_check.check_refund),
+        'check_chargeback': (lambda: (df_p, df_s), pagarme_check.check_chargeback),
+        'check_payables_refund_reversal': (lambda: (df_p, df_s), pagarme_check.check_payables_refund_reversal),
+        'reconciliation_engine': (lambda: (df_p, df_t, df_s),
+                                  lambda *frames: pagarme_check.ReconciliationEngine(*frames).run()),
+        'load_extrato_diario_cold': (lambda: (), lambda: load_extrato_diario(cache_folder=None)),
+        'adjust_extrato': (lambda: (), pagarme_validation.adjust_extrato),
+        'extrato_check': (lambda: (df_sales.copy(),), pagarme_validation.extrato_check),
+        'extrato_check_by_month': (lambda: (), pagarme_validation.extrato_check_by_month),
+    }
+
+
+def measure(name, setup, stage_function, repeat):
+    # Best of repeat instrumented runs, then one tracemalloc pass for the peak of python / numpy allocations
+    records = []
+    for _ in range(repeat):
+        args = setup()
+        with stage(name) as record:
+            stage_function(*args)
+        records.append(record)
+    best = min(records, key=lambda record: record['wall_seconds'])
+    args = setup()
+    with paused():
+        tracemalloc.start()
+        stage_function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'seconds': best['wall_seconds'], 'cpu_seconds': best['cpu_seconds'],
+            'rss_peak_mb': max(record['rss_peak_mb'] or 0 for record in records), 'peak_mb': peak / 2 ** 20}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_stages(sizes, stages=None, repeat=3, workdir=None, seed=0):
+    os.environ["DATABASE_NAME"] = BENCHMARK_DATABASE_NAME
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='financial_check_benchmark_'))
+    cwd = os.getcwd()
+    run_at, revision = pd.Timestamp.now().isoformat(timespec='seconds'), git_revision()
+    results = []
+    start_run('benchmark', folder=os.path.abspath(os.environ.get("RUN_REPORT_FOLDER", 'run_reports')))
+    try:
+        for size in sizes:
+            df_payables, df_transactions, df_sales = prepare_workdir(workdir, size, seed)
+            for name, (setup, stage_function) in benchmark_stages(df_payables, df_transactions, df_sales).items():
+                if stages is not None and name not in stages:
+                    continue
+                result = measure(name, setup, stage_function, repeat)
+                results.append({'run_at': run_at, 'revision': revision, 'stage': name, 'transactions': size,
+                                'payables_rows': len(df_payables), 'sales_rows': len(df_sales), **result})
+                print(name, size, round(result['seconds'], 3), 's', round(result['peak_mb'], 1), 'MB', flush=True)
+    finally:
+        os.chdir(cwd)
+        finish_run()
+    return pd.DataFrame(results)
+
+
+def parity_database(n_transactions, seed=0):
+    # SQLite stand-in of the DB (DATABASE_URL) with the synthetic tables, plus the row ids and update times of the
+    # incremental sync and the cases where the two backends could match or round differently: payables with
+    # missing ids / statuses (also next to credit and refund ones) and single installment sales of 0.12 paid 0.125
+    # (12 cents, rounding half to even)
+    from database import db_engine
+    rng = np.random.default_rng(seed)
+    df_payables, df_transactions, df_sales = synthetic_tables(n_transactions, seed)
+    single = df_payables.index[df_payables.groupby('transaction_id')['type'].transform('size').eq(1).to_numpy() &
+                               df_payables['type'].eq('credit').to_numpy()]
+    half_cent = rng.choice(single, min(5, len(single)), replace=False)
+    df_payables.loc[half_cent, 'amount'] = 0.125
+    df_sales.loc[df_sales['gateway_id'].isin('1-' + df_payables.loc[half_cent, 'transaction_id'].astype(str)),
+                 'valor_parcela_total'] = 0.12
+    edge = rng.choice(df_payables.index.difference(half_cent), 10, replace=False)
+    df_payables.loc[edge[:5], 'transaction_id'] = np.nan
+    df_payables.loc[edge[5:], 'type'] = None
+    # Refund transactions with one more payable of missing status are not credit / refund only
+    types = df_payables.groupby('transaction_id')['type'].agg(frozenset)
+    refund_only = types.index[types == frozenset({'credit', 'refund'})][:3]
+    df_payables = pd.concat([df_payables, df_payables[df_payables['transaction_id'].isin(refund_only) &
+                                                      df_payables['type'].eq('credit')].assign(type=None)],
+                            ignore_index=True)
+    updated_at = pd.Timestamp.now().floor('s')
+    tables = {'pagarme_payables': df_payables.assign(id=np.arange(len(df_payables)),
+                                                     pagarme_payables_updated_at=updated_at),
+              'pagarme_transactions': df_transactions.assign(pagarme_transactions_updated_at=updated_at),
+              'sales': df_sales.assign(id=np.arange(len(df_sales)), updated_at=updated_at, gateway_name='pagarme')}
+    for name, df in tables.items():
+        df.to_sql(name, db_engine(), index=False, if_exists='replace')
+
+
+def same_results(expected, got):
+    # Same ids in the same order (NA where NA) and same counts
+    if isinstance(expected, tuple):
+        return isinstance(got, tuple) and len(expected) == len(got) and all(map(same_results, expected, got))
+    if isinstance(expected, list):
+        return isinstance(got, list) and len(expected) == len(got) and \
+            all((pd.isna(a) and pd.isna(b)) or a == b for a, b in zip(expected, got))
+    return expected == got
+
+
+def bench_parity(sizes, workdir=None, seed=0):
+    # The DuckDB backend must return exactly the ReconciliationEngine result lists, from both caches. The caches
+    # are filled from a SQLite stand-in of the DB by the sync paths of financial_check sync (stream: feather files,
+    # incremental: parquet store)
+    from duckdb_check import duckdb_reconciliation
+    os.environ["DATABASE_NAME"] = BENCHMARK_DATABASE_NAME
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='financial_check_parity_'))
+    os.environ["DATABASE_URL"] = 'sqlite:///' + os.path.join(workdir, BENCHMARK_DATABASE_NAME + '.sqlite')
+    cwd = os.getcwd()
+    file_names = ['pagarme_payables', 'pagarme_transactions', 'pagarme_sales']
+    results = []
+    try:
+        for size in sizes:
+            # Caches and sync state start empty on every run
+            size_folder = os.path.join(workdir, 'parity_n' + str(size))
+            shutil.rmtree(size_folder, ignore_errors=True)
+            os.makedirs(size_folder)
+            os.chdir(size_folder)
+            parity_database(size, seed)
+            pagarme_check.db_bulk_stream()
+            pagarme_check.db_sync()
+            for source, load in [('feather', pagarme_check.local_df_load), ('parquet', pagarme_check.local_store_load)]:
+                df_payables, df_transactions, df_sales = load(file_names)
+                expected = pagarme_check.ReconciliationEngine(pagarme_check.payables_adjust(df_payables),
+                                                              pagarme_check.transactions_adjust(df_transactions),
+                                                              pagarme_check.sales_adjust(df_sales)).run()
+                got = duckdb_reconciliation(parquet_store=source == 'parquet')
+                results += [{'transactions': size, 'source': source, 'rule': name,
+                             'match': same_results(expected[name], got.get(name))} for name in expected]
+    finally:
+        os.chdir(cwd)
+    return pd.DataFrame(results)
+
+
+def sqlite_datetime(value):
+    # Datetimes as pandas writes them to SQLite, so the stand-in compares them as text like the synced marks
+    return pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def reconcile_database_update(step, seed=0):
+    # Changes to the SQLite stand-in synced before an incremental reconcile. Step 1 changes payables amounts and
+    # transactions installments, adds chargeback payables and moves payables / sales rows to another month
+    # partition (some with a new sales amount). Step 2 reverts half of the amount changes, so their issues close,
+    # and changes other sales amounts
+    from sqlalchemy import text
+    from database import db_engine
+    rng = np.random.default_rng(seed + step)
+    at = sqlite_datetime(pd.Timestamp.now().floor('s') + pd.Timedelta(seconds=step))
+
+    def ids(values):
+        return "(" + ", ".join(map(str, values)) + ")"
+
+    with db_engine().connect() as conn:
+        df_payables = pd.read_sql(text("SELECT id, transaction_id, type FROM pagarme_payables"), conn)
+        credit = df_payables[df_payables['type'].eq('credit') & df_payables['transaction_id'].notna()]
+        sales_ids = pd.read_sql(text("SELECT id FROM sales"), conn)['id']
+        # Same rows in both steps (same generator draws)
+        changed = np.random.default_rng(seed).choice(credit['id'], 20, replace=False).tolist()
+        if step == 1:
+            conn.execute(text("UPDATE pagarme_payables SET amount = amount + 1, pagarme_payables_updated_at = :at "
+                              "WHERE id IN " + ids(changed)), {'at': at})
+            conn.execute(text("UPDATE pagarme_payables SET data_de_competencia = :month, "
+                              "pagarme_payables_updated_at = :at WHERE id IN " +
+                              ids(rng.choice(df_payables['id'], 10, replace=False))),
+                         {'month': sqlite_datetime('2024-06-15'), 'at': at})
+            df_chargeback = pd.read_sql(text("SELECT * FROM pagarme_payables WHERE id IN " +
+                                             ids(rng.choice(credit['id'], 5, replace=False))), conn)
+            df_chargeback.assign(id=df_payables['id'].max() + 1 + np.arange(len(df_chargeback)), type='chargeback',
+                                 amount=-df_chargeback['amount'], pagarme_payables_updated_at=at).\
+                to_sql('pagarme_payables', conn, index=False, if_exists='append')
+            conn.execute(text("UPDATE pagarme_transactions SET installments = installments + 1, "
+                              "pagarme_transactions_updated_at = :at WHERE transaction_id IN " +
+                              ids(rng.choice(credit['transaction_id'].astype('int64'), 10, replace=False))),
+                         {'at': at})
+            conn.execute(text("UPDATE sales SET recebimento_financiamento = :month, updated_at = :at, "
+                              "valor_parcela_total = valor_parcela_total + CASE WHEN id % 2 = 0 THEN 1 ELSE 0 END "
+                              "WHERE id IN " + ids(rng.choice(sales_ids, 20, replace=False))),
+                         {'month': sqlite_datetime('2024-06-15'), 'at': at})
+        else:
+            conn.execute(text("UPDATE pagarme_payables SET amount = amount - 1, pagarme_payables_updated_at = :at "
+                              "WHERE id IN " + ids(changed[:10])), {'at': at})
+            conn.execute(text("UPDATE sales SET valor_parcela_total = valor_parcela_total + 1, updated_at = :at "
+                              "WHERE id IN " + ids(rng.choice(sales_ids, 20, replace=False))), {'at': at})
+        conn.commit()
+
+
+def store_matches_database(file_name, table):
+    # Every row of the DB table once in the parquet store, in the partition of its month
+    from sqlalchemy import text
+    from database import db_engine
+    from discrepancies import store_partition_files
+    config = pagarme_check.SYNC_TABLES[file_name]
+    key = config['key']
+    frames = []
+    for partition_file in store_partition_files(file_name):
+        df = pd.read_parquet(partition_file, columns=[key, config['partition']])
+        partition = os.path.basename(os.path.dirname(partition_file))
+        frames.append(df.assign(in_month=(partition == 'month=' + pagarme_check.local_store_month(df, file_name)).
+                                to_numpy(bool)))
+    df_store = pd.concat(frames, ignore_index=True)
+    with db_engine().connect() as conn:
+        db_keys = pd.read_sql(text("SELECT " + key + " FROM " + table), conn)[key]
+    return bool(df_store['in_month'].all() and df_store[key].is_unique and
+                set(df_store[key].tolist()) == set(db_keys.tolist()))
+
+
+def reconcile_matches_full(df_store, names):
+    # Open issues of these rules in the discrepancy store are the issues of a full recompute over the parquet store
+    from discrepancies import RULE_ISSUES, discrepancy_issues, reconcile_rules
+    results, _ = reconcile_rules(names)
+    expected = discrepancy_issues(results)
+    issues = [issue for name in names for issue in RULE_ISSUES[name] if issue is not None]
+    df_open = df_store[df_store['open'].to_numpy(bool) & df_store['issue'].isin(issues).to_numpy(bool)]
+    return set(zip(df_open['transaction_id'], df_open['issue'])) == set(zip(expected['transaction_id'],
+                                                                            expected['issue']))
+
+
+def bench_reconcile(sizes, workdir=None, seed=0):
+    # Incremental reconcile (discrepancies.reconcile_incremental) against a full recompute, over a parquet store
+    # synced from a SQLite stand-in of the DB: a rule subset first, then all rules, after updates that open and
+    # close issues and move rows between month partitions. Also checks the store against the DB, that rules which
+    # did not run keep their last_seen and that change files are pruned once every rule has reconciled them
+    from discrepancies import RULE_ISSUES, reconcile_incremental
+    os.environ["DATABASE_NAME"] = BENCHMARK_DATABASE_NAME
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='financial_check_reconcile_'))
+    os.environ["DATABASE_URL"] = 'sqlite:///' + os.path.join(workdir, BENCHMARK_DATABASE_NAME + '.sqlite')
+    cwd = os.getcwd()
+    results = []
+    try:
+        for size in sizes:
+            size_folder = os.path.join(workdir, 'reconcile_n' + str(size))
+            shutil.rmtree(size_folder, ignore_errors=True)
+            os.makedirs(size_folder)
+            os.chdir(size_folder)
+            parity_database(size, seed)
+
+            def check(step, name, match):
+                results.append({'transactions': size, 'step': step, 'check': name, 'match': bool(match)})
+
+            def change_files():
+                return sum(len(pagarme_check.sync_change_files(file_name)) for file_name in pagarme_check.SYNC_TABLES)
+
+            # Rule subset on an empty discrepancy store, then every rule
+            pagarme_check.db_sync()
+            df_store, _ = reconcile_incremental(['refund'])
+            check('refund first', 'refund issues', reconcile_matches_full(df_store, ['refund']))
+            df_store, _ = reconcile_incremental()
+            check('all rules', 'all issues', reconcile_matches_full(df_store, list(RULE_ISSUES)))
+
+            # Updates that open issues and move rows between month partitions
+            reconcile_database_update(1, seed)
+            check('update', 'sync fetches changed rows only', sum(pagarme_check.db_sync().values()) < size)
+            for file_name, table in [('pagarme_payables', 'pagarme_payables'), ('pagarme_sales', 'sales')]:
+                check('update', file_name + ' store', store_matches_database(file_name, table))
+            df_store, checked = reconcile_incremental()
+            check('update', 'all issues', reconcile_matches_full(df_store, list(RULE_ISSUES)))
+            check('update', 'changed transactions only', 0 < checked < size)
+            check('update', 'change files pruned', change_files() == 0)
+
+            # Updates that close issues, reconciled by one rule and then by all of them
+            df_before = df_store
+            reconcile_database_update(2, seed)
+            pagarme_check.db_sync()
+            refund_issues = df_store[df_store['issue'].str.startswith('refund_').to_numpy(bool)]
+            df_store, _ = reconcile_incremental(['chargeback'])
+            check('chargeback only', 'chargeback issues', reconcile_matches_full(df_store, ['chargeback']))
+            check('chargeback only', 'refund issues untouched',
+                  df_store[df_store['issue'].str.startswith('refund_').to_numpy(bool)].reset_index(drop=True).
+                  equals(refund_issues.reset_index(drop=True)))
+            # The other rules have not reconciled the last sync yet
+            check('chargeback only', 'change files kept', change_files() > 0)
+            df_store, _ = reconcile_incremental()
+            check('revert', 'all issues', reconcile_matches_full(df_store, list(RULE_ISSUES)))
+            check('revert', 'change files pruned', change_files() == 0)
+            # Issues no longer found are closed, not dropped
+            was_open = set(zip(df_before.loc[df_before['open'], 'transaction_id'],
+                               df_before.loc[df_before['open'], 'issue']))
+            now_open = set(zip(df_store.loc[df_store['open'], 'transaction_id'],
+                               df_store.loc[df_store['open'], 'issue']))
+            kept = set(zip(df_store['transaction_id'], df_store['issue']))
+            check('revert', 'issues closed', len(was_open - now_open) > 0 and was_open <= kept)
+    finally:
+        os.chdir(cwd)
+    return pd.DataFrame(results)
+
+
+def compare_previous(df_results, output):
+    # Ratio to the last saved run of each stage and size (> 1 is slower / more memory than before)
+    if not os.path.exists(output):
+        return df_results
+    df_previous = pd.read_csv(output).groupby(['stage', 'transactions']).last()[['revision', 'seconds', 'peak_mb']]
+    df = df_results.join(df_previous, on=['stage', 'transactions'], rsuffix='_previous')
+    df['seconds_ratio'] = df['seconds'] / df['seconds_previous']
+    df['peak_mb_ratio'] = df['peak_mb'] / df['peak_mb_previous']
+    return df
+
+
+def save_results(df_results, output):
+    df_results.to_csv(output, mode='a', header=not os.path.exists(output), index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconciliation checks benchmark')
+    parser.add_argument('--suite', choices=['stages', 'chargeback', 'parity', 'reconcile'], default='stages',
+                        help='every stage on synthetic tables, the chargeback check scaling only, the DuckDB '
+                             'backend results against pandas or the incremental reconcile against a full one '
+                             '(parity / reconcile exit 1 on any difference)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='number of transactions (payables rows are ~2x)')
+    parser.add_argument('--stages', nargs='+', help='only these stages (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', help='folder for the generated data, reused between runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=BENCHMARK_RESULTS, help='csv the results are appended to')
+    args = parser.parse_args()
+
+    if args.suite == 'chargeback':
+        print(bench_chargeback(args.sizes, args.repeat).to_string(index=False))
+    elif args.suite in ('parity', 'reconcile'):
+        df_checks = (bench_parity if args.suite == 'parity' else bench_reconcile)(args.sizes, args.workdir, args.seed)
+        print(df_checks.to_string(index=False))
+        sys.exit(0 if df_checks['match'].all() else 1)
+    else:
+        output = os.path.abspath(args.output)
+        df_results = bench_stages(args.sizes, args.stages, args.repeat, args.workdir, args.seed)
+        print(compare_previous(df_results, output).drop(columns=['run_at']).to_string(index=False))
+        save_results(df_results, output)
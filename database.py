@@ -0,0 +1,37 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Single engine per process: every db_load shares its connection pool
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def db_url():
+    # DATABASE_URL allows pointing the checks to another DB (e.g. a local sqlite stand-in)
+    if os.environ.get("DATABASE_URL"):
+        return os.environ.get("DATABASE_URL")
+    return "mysql+pymysql://{user}:{pw}@{ep}:{port}/{db}".format(user=os.environ.get("DATABASE_USER"),
+                                                                  pw=os.environ.get("DATABASE_PASS"),
+                                                                  ep=os.environ.get("DATABASE_HOST"),
+                                                                  port=os.environ.get("DATABASE_PORT"),
+                                                                  db=os.environ.get("DATABASE_NAME"))
+
+
+def db_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            from sqlalchemy import create_engine
+            url = db_url()
+            pool_options = {}
+            if not url.startswith('sqlite'):
+                # Enough connections to load payables, transactions and sales concurrently
+                pool_options = {'pool_size': int(os.environ.get("DATABASE_POOL_SIZE", 5)),
+                                'max_overflow': int(os.environ.get("DATABASE_MAX_OVERFLOW", 5)),
+                                'pool_recycle': 3600}
+            _engine = create_engine(url, pool_pre_ping=True, **pool_options)
+    return _engine
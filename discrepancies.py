@@ -0,0 +1,211 @@
+import json
+import os
+import pandas as pd
+
+from dotenv import load_dotenv
+
+from instrumentation import instrumented
+from pagarme_check import RECONCILIATION_RULES, SYNC_TABLES, ReconciliationEngine, local_store_load, \
+    local_store_path, payables_adjust, sales_adjust, store_transaction_ids, sync_change_files, sync_changes_path, \
+    transactions_adjust
+
+load_dotenv()
+
+# Incremental reconciliation over the monthly parquet store: the rules only look at the rows of one transaction,
+# so after a sync only the transactions of the change files (see pagarme_check.sync_changes_save) a rule has not
+# reconciled yet are re-checked, reading just their rows. Verdicts are kept in <DATABASE_NAME>_discrepancies.parquet,
+# one row per (transaction_id, issue): first_seen / last_seen run and whether the issue is still open.
+
+# Issue name of every result list of the rules (None: a count over all transactions, not kept per transaction)
+RULE_ISSUES = {
+    'single_occurancy': ['unique_status_not_credit', 'unique_status_installments', 'unique_status_sales_refund',
+                         'unique_status_missing_sales', 'unique_status_values_diff'],
+    'refund': ['refund_no_sales', 'refund_sum_error'],
+    'chargeback': ['chargeback_refund_no_chargeback', 'chargeback_no_counterpart', None, 'chargeback_sum_error'],
+    'payables_refund_reversal': ['refund_reversal_sum_error'],
+}
+DISCREPANCY_COLUMNS = ['transaction_id', 'issue', 'first_seen', 'last_seen', 'open']
+
+
+def reconcile_state_path():
+    return os.environ.get("DATABASE_NAME") + "_reconcile_state.json"
+
+
+def reconcile_state_load():
+    # Per rule: the last change file of each table it reconciled (states of another format are dropped, so those
+    # rules are checked in full)
+    if not os.path.exists(reconcile_state_path()):
+        return {}
+    with open(reconcile_state_path()) as f:
+        state = json.load(f)
+    return {name: rule_state for name, rule_state in state.items()
+            if name in RULE_ISSUES and isinstance(rule_state, dict)}
+
+
+def reconcile_state_save(state):
+    with open(reconcile_state_path() + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(reconcile_state_path() + '.tmp', reconcile_state_path())
+
+
+def discrepancy_store_path():
+    return os.environ.get("DATABASE_NAME") + "_discrepancies.parquet"
+
+
+def discrepancy_store_load():
+    if not os.path.exists(discrepancy_store_path()):
+        return pd.DataFrame({'transaction_id': pd.Series(dtype='Int64'), 'issue': pd.Series(dtype='string'),
+                             'first_seen': pd.Series(dtype='datetime64[ns]'),
+                             'last_seen': pd.Series(dtype='datetime64[ns]'), 'open': pd.Series(dtype='bool')})
+    return pd.read_parquet(discrepancy_store_path())
+
+
+def discrepancy_store_save(df_store):
+    df_store.to_parquet(discrepancy_store_path() + '.tmp', index=False)
+    os.replace(discrepancy_store_path() + '.tmp', discrepancy_store_path())
+
+
+def store_partition_files(file_name):
+    store_path = local_store_path(file_name)
+    if not os.path.exists(store_path):
+        return []
+    return [os.path.join(store_path, partition, 'data.parquet') for partition in sorted(os.listdir(store_path))]
+
+
+def latest_change_files():
+    # Last change file of every table that has one
+    latest = {}
+    for file_name in SYNC_TABLES:
+        change_files = sync_change_files(file_name)
+        if change_files:
+            latest[file_name] = change_files[-1]
+    return latest
+
+
+def changed_transaction_ids(rule_state):
+    # Transactions of the change files synced after the ones of the rule state (only those files are read)
+    frames = []
+    for file_name in SYNC_TABLES:
+        for change_file in sync_change_files(file_name):
+            if rule_state.get(file_name) is None or change_file > rule_state[file_name]:
+                frames.append(pd.read_parquet(os.path.join(sync_changes_path(file_name), change_file)))
+    if not frames:
+        return pd.Index([], dtype='Int64')
+    return pd.Index(pd.concat(frames, ignore_index=True)['transaction_id'].dropna().unique(), dtype='Int64')
+
+
+def sync_changes_prune(state):
+    # Change files every rule with a state has reconciled are not needed anymore
+    for file_name in SYNC_TABLES:
+        marks = [rule_state.get(file_name) for rule_state in state.values()]
+        if not marks or None in marks:
+            continue
+        for change_file in sync_change_files(file_name):
+            if change_file <= min(marks):
+                os.remove(os.path.join(sync_changes_path(file_name), change_file))
+
+
+def store_load_transactions(file_name, transaction_ids):
+    # Rows of these transactions only (as local_store_load, without sync columns). The id filter is pushed down to
+    # the parquet reader; rows without the id column value (sales synced before it was stored) are matched after
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    columns = SYNC_TABLES[file_name]['columns']
+    ids = pa.array(transaction_ids.to_numpy('int64'), pa.int64())
+    frames = []
+    for partition_file in store_partition_files(file_name):
+        schema = pq.read_schema(partition_file)
+        if 'transaction_id' in schema.names:
+            id_field = ds.field('transaction_id')
+            id_filter = id_field.isin(pc.cast(ids, schema.field('transaction_id').type)) | id_field.is_null()
+            df = pq.read_table(partition_file, filters=id_filter).to_pandas()
+        else:
+            df = pd.read_parquet(partition_file)
+        frames.append(df[store_transaction_ids(df, file_name).isin(transaction_ids).to_numpy(bool)])
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    return df[[c for c in df.columns if c in columns]]
+
+
+def discrepancy_issues(results):
+    # Rule results as (transaction_id, issue) rows (missing ids cannot be tracked and are left out)
+    frames = []
+    for name, result in results.items():
+        for issue, transaction_ids in zip(RULE_ISSUES[name], result if isinstance(result, tuple) else (result,)):
+            if issue is not None:
+                frames.append(pd.DataFrame({'transaction_id': pd.array(transaction_ids, dtype='Int64'),
+                                            'issue': issue}))
+    if not frames:
+        return pd.DataFrame({'transaction_id': pd.Series(dtype='Int64'), 'issue': pd.Series(dtype='string')})
+    df = pd.concat(frames, ignore_index=True).dropna(subset=['transaction_id']).drop_duplicates()
+    return df.astype({'issue': 'string'})
+
+
+def discrepancy_store_update(df_store, df_issues, checked_ids, checked_issues, run_at):
+    # Issues of the rules that ran: checked transactions take the new verdicts (still found: last_seen = run_at, no
+    # longer found: closed) and open issues of the other transactions cannot have changed, so they are seen again.
+    # Issues of the rules that did not run are kept as they are
+    of_rules = df_store['issue'].isin(checked_issues).to_numpy(bool)
+    checked = of_rules & df_store['transaction_id'].isin(checked_ids).to_numpy(bool)
+    df_unchecked = df_store[~checked].copy()
+    df_unchecked.loc[df_unchecked['open'].to_numpy(bool) & of_rules[~checked], 'last_seen'] = run_at
+    df_checked = df_store[checked].merge(df_issues.assign(found=True), on=['transaction_id', 'issue'], how='outer')
+    found = df_checked['found'].eq(True).to_numpy(bool)
+    df_checked['first_seen'] = df_checked['first_seen'].fillna(run_at)
+    df_checked.loc[found, 'last_seen'] = run_at
+    df_checked['open'] = found
+    return pd.concat([df_unchecked, df_checked[DISCREPANCY_COLUMNS]], ignore_index=True).\
+        sort_values(['transaction_id', 'issue']).reset_index(drop=True)
+
+
+def reconcile_rules(names, transaction_ids=None):
+    # Results of the rules over these transactions (every transaction of the store when None) and the ids checked
+    file_names = ['pagarme_payables', 'pagarme_transactions', 'pagarme_sales']
+    if transaction_ids is None:
+        df_payables, df_transactions, df_sales = local_store_load(file_names)
+        transaction_ids = pd.Index(pd.concat([store_transaction_ids(df_payables, 'pagarme_payables'),
+                                              store_transaction_ids(df_transactions, 'pagarme_transactions'),
+                                              store_transaction_ids(df_sales, 'pagarme_sales')]).dropna().unique())
+    elif transaction_ids.empty:
+        return {}, transaction_ids
+    else:
+        df_payables, df_transactions, df_sales = [store_load_transactions(file_name, transaction_ids)
+                                                  for file_name in file_names]
+    results = ReconciliationEngine(payables_adjust(df_payables), transactions_adjust(df_transactions),
+                                   sales_adjust(df_sales)).run(names)
+    return results, transaction_ids
+
+
+@instrumented()
+def reconcile_incremental(names=None, full=False):
+    # Every rule keeps its own state: rules without one (or all of them with full) check every transaction, the
+    # others only the transactions of the change files synced since. Returns the store and the number of
+    # transactions checked
+    names = list(RECONCILIATION_RULES) if names is None else names
+    run_at = pd.Timestamp.now()
+    state = reconcile_state_load()
+    # Taken before reading the store: rows synced meanwhile are checked by the next run
+    latest = latest_change_files()
+    # Rules with the same state are run together
+    groups = {}
+    for name in names:
+        rule_state = None if full else state.get(name)
+        groups.setdefault(None if rule_state is None else json.dumps(rule_state, sort_keys=True), []).append(name)
+    df_store = discrepancy_store_load()
+    checked_ids = []
+    for rule_state, group in groups.items():
+        results, transaction_ids = reconcile_rules(
+            group, None if rule_state is None else changed_transaction_ids(json.loads(rule_state)))
+        checked_issues = [issue for name in group for issue in RULE_ISSUES[name] if issue is not None]
+        df_store = discrepancy_store_update(df_store, discrepancy_issues(results), transaction_ids, checked_issues,
+                                            run_at)
+        checked_ids.append(pd.Series(transaction_ids, dtype='Int64'))
+    discrepancy_store_save(df_store)
+    # The states move only after the store is written: an interrupted run re-checks the same transactions
+    state.update({name: latest for name in names})
+    reconcile_state_save(state)
+    sync_changes_prune(state)
+    return df_store, pd.concat(checked_ids).nunique() if checked_ids else 0
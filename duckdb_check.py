@@ -0,0 +1,208 @@
+import os
+import pandas as pd
+import pyarrow as pa
+
+from dotenv import load_dotenv
+
+from instrumentation import instrumented
+from pagarme_check import PAYABLES_COLUMNS, SALES_COLUMNS, TRANSACTIONS_COLUMNS, local_df_path, local_store_path
+
+load_dotenv()
+
+# Out of core backend: the payables checks of ReconciliationEngine as SQL over the local cache (feather files or
+# the monthly parquet store), run by DuckDB. Tables are scanned batch by batch and DuckDB spills to
+# DUCKDB_TEMP_DIRECTORY above DUCKDB_MEMORY_LIMIT, so the cache may be larger than RAM.
+# duckdb is optional: it is only imported when this backend runs.
+
+# Same conversions as schema.to_id / to_installment and money.to_cents (numpy rounds half to even)
+DUCKDB_MACROS = [
+    "CREATE MACRO to_id(x) AS coalesce(TRY_CAST(x AS BIGINT), TRY_CAST(TRY_CAST(x AS DOUBLE) AS BIGINT))",
+    "CREATE MACRO to_installment(x) AS coalesce(TRY_CAST(x AS SMALLINT), TRY_CAST(TRY_CAST(x AS DOUBLE) AS SMALLINT))",
+    "CREATE MACRO to_cents(x) AS CAST(round_even(CAST(x AS DOUBLE) * 100, 0) AS BIGINT)",
+]
+
+# Adjusted tables, as payables_adjust / sales_adjust / transactions_adjust. _row is the row position in the cache,
+# p_row the position after payables_adjust sorting (first occurrence order of the pandas result lists)
+DUCKDB_TABLES = {
+    'payables': """
+        SELECT row_number() OVER (ORDER BY data_venda NULLS LAST, transaction_id NULLS LAST,
+                                           installment NULLS LAST, _row) AS p_row, *
+        FROM (SELECT _row, date_trunc('day', TRY_CAST(data_de_competencia AS TIMESTAMP)) AS data_venda,
+                     to_id(transaction_id) AS transaction_id, to_installment(installment) AS installment,
+                     to_cents(amount) AS valor, CAST(type AS VARCHAR) AS status
+              FROM pagarme_payables_source)""",
+    'sales': """
+        SELECT to_id(string_split(gateway_id, '-')[2]) AS transaction_id,
+               to_installment(string_split(gateway_id, '-')[1]) AS installment,
+               to_cents(valor_parcela_total) AS valor, to_cents(coalesce(valor_cancelamento, 0)) AS refund
+        FROM pagarme_sales_source""",
+    'transactions': """
+        SELECT _row AS t_row, to_id(transaction_id) AS transaction_id, to_installment(installments) AS installments
+        FROM pagarme_transactions_source""",
+    # Shared aggregates (the ReconciliationEngine cached properties)
+    'status_ids': """
+        SELECT status, transaction_id, min(p_row) AS first_row FROM payables
+        WHERE status IS NOT NULL GROUP BY status, transaction_id""",
+    'p_sum': """
+        SELECT transaction_id, coalesce(sum(valor), 0) AS p_sum FROM payables
+        WHERE transaction_id IS NOT NULL GROUP BY transaction_id""",
+    's_sum': """
+        SELECT transaction_id, coalesce(sum(valor), 0) + coalesce(sum(refund), 0) AS s_sum FROM sales
+        WHERE transaction_id IS NOT NULL GROUP BY transaction_id""",
+    's_installment': """
+        SELECT transaction_id, installment, min(valor) AS valor_min, max(valor) AS valor_max,
+               bool_or(valor IS NULL) AS valor_na, bool_or(refund <> 0) AS refund_nonzero FROM sales
+        WHERE transaction_id IS NOT NULL AND installment IS NOT NULL GROUP BY transaction_id, installment""",
+    'unique_status': """
+        SELECT p.* FROM payables p JOIN (SELECT transaction_id FROM payables WHERE transaction_id IS NOT NULL
+                                         GROUP BY transaction_id HAVING count(DISTINCT status) = 1) USING (transaction_id)""",
+}
+
+FEATHER_COLUMNS = {'pagarme_payables': PAYABLES_COLUMNS, 'pagarme_transactions': TRANSACTIONS_COLUMNS,
+                   'pagarme_sales': SALES_COLUMNS}
+
+
+def duckdb_connect():
+    import duckdb
+    con = duckdb.connect()
+    con.execute("SET memory_limit = '" + os.environ.get("DUCKDB_MEMORY_LIMIT", '4GB') + "'")
+    con.execute("SET temp_directory = '" + os.environ.get("DUCKDB_TEMP_DIRECTORY",
+                                                          os.environ.get("DATABASE_NAME") + "_duckdb_tmp") + "'")
+    # Row order is carried in explicit columns, so scans do not need to keep it
+    con.execute("SET preserve_insertion_order = false")
+    for macro in DUCKDB_MACROS:
+        con.execute(macro)
+    return con
+
+
+def feather_batches(path, columns):
+    # Cached feather file as a stream of record batches with their row position (_row)
+    reader = pa.ipc.open_file(path)
+    columns = [column for column in columns if column in reader.schema.names]
+    schema = pa.schema([reader.schema.field(column) for column in columns] + [pa.field('_row', pa.int64())])
+
+    def batches():
+        offset = 0
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(columns)
+            yield pa.RecordBatch.from_arrays(batch.columns + [pa.array(range(offset, offset + batch.num_rows),
+                                                                       pa.int64())], schema=schema)
+            offset += batch.num_rows
+    return pa.RecordBatchReader.from_batches(schema, batches())
+
+
+def duckdb_register_sources(con, parquet_store=False):
+    # <file_name>_source views over the feather files, or over the monthly parquet store when parquet_store
+    for file_name, columns in FEATHER_COLUMNS.items():
+        if parquet_store:
+            # Partitions in name order, as local_store_load concatenates them
+            con.execute("CREATE VIEW " + file_name + "_source AS SELECT *, row_number() OVER "
+                        "(ORDER BY filename, file_row_number) - 1 AS _row FROM read_parquet('" +
+                        local_store_path(file_name) + "/*/data.parquet', filename = true, file_row_number = true, "
+                        "union_by_name = true, hive_partitioning = false)")
+        else:
+            con.register(file_name + "_source", feather_batches(local_df_path(file_name), columns))
+
+
+def duckdb_ids(con, query):
+    # Result list as the pandas path returns it (missing ids as pd.NA)
+    return [pd.NA if transaction_id is None else transaction_id for (transaction_id,) in con.execute(query).fetchall()]
+
+
+def duckdb_rule_single_occurancy(con):
+    credit = "(SELECT * FROM unique_status WHERE status = 'credit')"
+    invalid_unique_st_status = duckdb_ids(con, """
+        SELECT transaction_id FROM unique_status WHERE status IS DISTINCT FROM 'credit'
+        GROUP BY transaction_id ORDER BY min(p_row)""")
+    invalid_unique_st_installments = duckdb_ids(con, """
+        SELECT t.transaction_id FROM transactions t
+        JOIN (SELECT transaction_id, count(*) AS credit_rows FROM """ + credit + """ GROUP BY transaction_id) c
+        USING (transaction_id)
+        WHERE coalesce(t.installments, 1) <> c.credit_rows GROUP BY t.transaction_id ORDER BY min(t.t_row)""")
+    invalid_unique_st_s_refund = duckdb_ids(con, """
+        SELECT c.transaction_id FROM """ + credit + """ c JOIN s_installment s USING (transaction_id, installment)
+        WHERE s.refund_nonzero GROUP BY c.transaction_id ORDER BY min(c.p_row)""")
+    invalid_unique_st_missing_s = duckdb_ids(con, """
+        SELECT c.transaction_id FROM """ + credit + """ c LEFT JOIN s_installment s USING (transaction_id, installment)
+        WHERE s.valor_na IS NOT FALSE GROUP BY c.transaction_id ORDER BY min(c.p_row)""")
+    invalid_unique_st_valuesDiff = duckdb_ids(con, """
+        SELECT c.transaction_id FROM """ + credit + """ c JOIN s_installment s USING (transaction_id, installment)
+        WHERE coalesce(s.valor_max <> c.valor, false) OR coalesce(s.valor_min <> c.valor, false)
+        GROUP BY c.transaction_id ORDER BY min(c.p_row)""")
+    return invalid_unique_st_status, invalid_unique_st_installments, invalid_unique_st_s_refund, \
+           invalid_unique_st_missing_s, invalid_unique_st_valuesDiff
+
+
+def duckdb_rule_refund(con):
+    refund_only = """(SELECT transaction_id, min(p_row) AS first_row FROM payables WHERE transaction_id IS NOT NULL
+                      GROUP BY transaction_id HAVING count(DISTINCT status) = 2 AND bool_or(status = 'credit')
+                      AND bool_or(status = 'refund') AND bool_and(status IS NOT NULL))"""
+    invalid_refund_only_no_sales = duckdb_ids(con, """
+        SELECT r.transaction_id FROM """ + refund_only + """ r ANTI JOIN s_sum USING (transaction_id)
+        ORDER BY r.first_row""")
+    invalid_refund_only_sum_error = duckdb_ids(con, """
+        SELECT transaction_id FROM """ + refund_only + """ r JOIN s_sum USING (transaction_id)
+        JOIN p_sum USING (transaction_id) WHERE s_sum <> p_sum ORDER BY transaction_id""")
+    return invalid_refund_only_no_sales, invalid_refund_only_sum_error
+
+
+def duckdb_rule_chargeback(con):
+    # Id lists may hold a missing id, which is kept in the lists but never a member of another one (as pandas isin)
+    def status_list(status):
+        return "(SELECT transaction_id, first_row FROM status_ids WHERE status = '" + status + "')"
+
+    def member(alias, table):
+        return "EXISTS (SELECT 1 FROM " + table + " m WHERE m.transaction_id = " + alias + \
+               ".transaction_id)"
+
+    chargeback, chargeback_refund, credit = status_list('chargeback'), status_list('chargeback_refund'), \
+        status_list('credit')
+    chargeback_credit = "(SELECT transaction_id FROM " + credit + " c WHERE " + member('c', chargeback) + \
+                        " AND NOT " + member('c', chargeback_refund) + ")"
+    no_counterpart = "(SELECT transaction_id, first_row FROM " + chargeback + " cb WHERE NOT " + \
+                     member('cb', chargeback_refund) + " AND NOT " + member('cb', chargeback_credit) + ")"
+    invalid_chargeback_refund_no_chargeback = duckdb_ids(con, "SELECT transaction_id FROM " + chargeback_refund +
+                                                         " cbr WHERE NOT " + member('cbr', chargeback) +
+                                                         " ORDER BY first_row")
+    invalid_chargeback_no_counterpart = duckdb_ids(con, "SELECT transaction_id FROM " + no_counterpart +
+                                                   " ORDER BY first_row")
+    n_chargeback, n_chargeback_refund, n_chargeback_credit = con.execute(
+        "SELECT (SELECT count(*) FROM " + chargeback + "), (SELECT count(*) FROM " + chargeback_refund + "), "
+        "(SELECT count(*) FROM " + chargeback_credit + ")").fetchone()
+    invalid_chargeback_amount_check = (n_chargeback - len(invalid_chargeback_no_counterpart)) - \
+                                      (n_chargeback_refund - len(invalid_chargeback_refund_no_chargeback)) - \
+                                      n_chargeback_credit
+    invalid_chargeback_sum_error = duckdb_ids(con, """
+        SELECT transaction_id FROM """ + chargeback + """ cb JOIN s_sum USING (transaction_id)
+        JOIN p_sum USING (transaction_id)
+        WHERE NOT """ + member('cb', no_counterpart) + """ AND s_sum <> p_sum ORDER BY transaction_id""")
+    return invalid_chargeback_refund_no_chargeback, invalid_chargeback_no_counterpart, \
+           invalid_chargeback_amount_check, invalid_chargeback_sum_error
+
+
+def duckdb_rule_payables_refund_reversal(con):
+    return duckdb_ids(con, """
+        SELECT rr.transaction_id FROM status_ids rr LEFT JOIN p_sum USING (transaction_id)
+        LEFT JOIN s_sum USING (transaction_id)
+        WHERE rr.status = 'refund_reversal' AND coalesce(p_sum, 0) <> coalesce(s_sum, 0) ORDER BY rr.first_row""")
+
+
+DUCKDB_RULES = {
+    'single_occurancy': duckdb_rule_single_occurancy,
+    'refund': duckdb_rule_refund,
+    'chargeback': duckdb_rule_chargeback,
+    'payables_refund_reversal': duckdb_rule_payables_refund_reversal,
+}
+
+
+@instrumented()
+def duckdb_reconciliation(names=None, parquet_store=False):
+    # Same results as ReconciliationEngine(...).run(names) over the cached tables
+    con = duckdb_connect()
+    try:
+        duckdb_register_sources(con, parquet_store)
+        for table, query in DUCKDB_TABLES.items():
+            con.execute("CREATE TEMP TABLE " + table + " AS " + query)
+        return {name: DUCKDB_RULES[name](con) for name in (DUCKDB_RULES if names is None else names)}
+    finally:
+        con.close()
@@ -0,0 +1,200 @@
+import csv
+import hashlib
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from concurrent.futures import ThreadPoolExecutor
+from pyarrow import csv as pa_csv
+
+from instrumentation import instrumented
+
+# Directory containing the daily statement (extrato diario) csv files
+EXTRATO_FOLDER = './extrato_diario'
+# Parsed statements cache: one feather file per csv, valid while the csv keeps its size and mtime
+EXTRATO_CACHE_FOLDER = './extrato_diario_cache'
+# Known statement columns (lowercase headers) and the type they are parsed to at read time
+EXTRATO_DATE_FORMATS = ['%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y']
+EXTRATO_DATE_COLUMNS = ['data de pagamento', 'data de criação', 'data da operação']
+EXTRATO_MONEY_COLUMNS = ['entrada', 'saída', 'taxa total da operação']
+EXTRATO_COLUMN_TYPES = {'id da transação': pa.int64(), 'parcela': pa.string(),
+                        **{column: pa.timestamp('s') for column in EXTRATO_DATE_COLUMNS},
+                        # Amounts use pt-BR format ("1.234,56", "-"): read as text and parsed below
+                        **{column: pa.string() for column in EXTRATO_MONEY_COLUMNS}}
+
+
+def parse_brl_arrow(array):
+    # "1.234,56" -> 1234.56, "-" -> 0 and "" -> null, with arrow compute kernels over the whole column
+    array = pc.utf8_trim_whitespace(array)
+    array = pc.replace_substring(array, '.', '')
+    array = pc.replace_substring(array, ',', '.')
+    array = pc.if_else(pc.equal(array, '-'), '0', array)
+    array = pc.if_else(pc.equal(array, ''), pa.scalar(None, pa.string()), array)
+    return pc.cast(array, pa.float64())
+
+
+def parse_brl(values):
+    # pt-BR formatted amounts column to float64 (columns already numeric are only cast)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype('float64')
+    array = pa.array(values.astype('string'), type=pa.string())
+    return pd.Series(parse_brl_arrow(array).to_numpy(zero_copy_only=False), index=values.index, name=values.name)
+
+
+def extrato_files(folder_path=EXTRATO_FOLDER, recursive=True):
+    if not recursive:
+        return [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.endswith('.csv')]
+    return [os.path.join(subdir, file) for subdir, dirs, files in os.walk(folder_path)
+            for file in files if file.endswith('.csv')]
+
+
+def extrato_column_types(file_path):
+    # Column names are matched case insensitive against the known statement columns
+    with open(file_path, encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f), [])
+    return {name: EXTRATO_COLUMN_TYPES[name.lower()] for name in header if name.lower() in EXTRATO_COLUMN_TYPES}
+
+
+def read_extrato_csv(file_path, lowercase=True):
+    column_types = extrato_column_types(file_path)
+    table = pa_csv.read_csv(file_path, convert_options=pa_csv.ConvertOptions(
+        column_types=column_types, timestamp_parsers=EXTRATO_DATE_FORMATS, null_values=['', '-']))
+    for i, name in enumerate(table.column_names):
+        if name.lower() in EXTRATO_MONEY_COLUMNS:
+            table = table.set_column(i, name, parse_brl_arrow(table.column(i)))
+    if lowercase:
+        table = table.rename_columns([name.lower() for name in table.column_names])
+    return table
+
+
+def extrato_manifest_path(cache_folder):
+    return os.path.join(cache_folder, 'manifest.json')
+
+
+def extrato_manifest_load(cache_folder):
+    if not os.path.exists(extrato_manifest_path(cache_folder)):
+        return {}
+    with open(extrato_manifest_path(cache_folder)) as f:
+        return json.load(f)
+
+
+def extrato_manifest_save(cache_folder, manifest):
+    with open(extrato_manifest_path(cache_folder) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(extrato_manifest_path(cache_folder) + '.tmp', extrato_manifest_path(cache_folder))
+
+
+def extrato_payment_column(table):
+    # Name of the payment date column of a parsed statement (None when it has none)
+    return next((name for name in table.column_names if name.lower() == 'data de pagamento'), None)
+
+
+def extrato_payment_range(table):
+    # First and last payment date of a parsed statement, as iso strings (None when unknown)
+    column = extrato_payment_column(table)
+    if column is None or not pa.types.is_timestamp(table.schema.field(column).type):
+        return None, None
+    dates = pc.min_max(table.column(column))
+    if not dates['min'].is_valid:
+        return None, None
+    return dates['min'].as_py().isoformat(), dates['max'].as_py().isoformat()
+
+
+def extrato_cache_fresh(entry, stat, cache_folder):
+    # Cached table still valid: same size and mtime as the csv (entries without payment range predate it)
+    return entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and \
+        'paid_from' in entry and os.path.exists(os.path.join(cache_folder, entry['cache_file']))
+
+
+def read_extrato_cached(file_path, manifest, cache_folder):
+    # Returns the parsed csv (original column names) and its manifest entry, parsing only new or changed files
+    stat = os.stat(file_path)
+    entry = manifest.get(file_path)
+    if extrato_cache_fresh(entry, stat, cache_folder):
+        return feather.read_table(os.path.join(cache_folder, entry['cache_file'])), entry
+    table = read_extrato_csv(file_path, lowercase=False)
+    paid_from, paid_to = extrato_payment_range(table)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'cache_file': hashlib.sha1(file_path.encode()).hexdigest() + '.feather',
+             'paid_from': paid_from, 'paid_to': paid_to}
+    feather.write_feather(table, os.path.join(cache_folder, entry['cache_file']))
+    return table, entry
+
+
+def extrato_cache_evict(manifest, cache_folder):
+    # Drop entries whose source csv no longer exists (other folders may share the cache)
+    for file_path in [file_path for file_path in manifest if not os.path.exists(file_path)]:
+        cache_file = os.path.join(cache_folder, manifest.pop(file_path)['cache_file'])
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+
+@instrumented()
+def load_extrato_diario(folder_path=EXTRATO_FOLDER, recursive=True, lowercase=True,
+                        cache_folder=EXTRATO_CACHE_FOLDER):
+    files = extrato_files(folder_path, recursive)
+    if cache_folder is None:
+        # Files are read concurrently, each one with the multithreaded pyarrow csv reader
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            tables = list(executor.map(lambda file_path: read_extrato_csv(file_path, lowercase=False), files))
+    else:
+        os.makedirs(cache_folder, exist_ok=True)
+        manifest = extrato_manifest_load(cache_folder)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            cached = list(executor.map(lambda file_path: read_extrato_cached(file_path, manifest, cache_folder), files))
+        manifest.update({file_path: entry for file_path, (table, entry) in zip(files, cached)})
+        extrato_cache_evict(manifest, cache_folder)
+        extrato_manifest_save(cache_folder, manifest)
+        tables = [table for table, entry in cached]
+    if lowercase:
+        tables = [table.rename_columns([name.lower() for name in table.column_names]) for table in tables]
+    # Concatenate tables vertically (columns missing in some files are filled with nulls)
+    return pa.concat_tables(tables, promote_options='permissive').to_pandas()
+
+
+@instrumented()
+def extrato_cache_refresh(folder_path=EXTRATO_FOLDER, recursive=True, cache_folder=EXTRATO_CACHE_FOLDER):
+    # Parses the new or changed csv files into the cache, without reading the cached ones, and returns the manifest
+    os.makedirs(cache_folder, exist_ok=True)
+    manifest = extrato_manifest_load(cache_folder)
+    stale = [file_path for file_path in extrato_files(folder_path, recursive)
+             if not extrato_cache_fresh(manifest.get(file_path), os.stat(file_path), cache_folder)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        entries = list(executor.map(lambda file_path: read_extrato_cached(file_path, manifest, cache_folder)[1], stale))
+    manifest.update(zip(stale, entries))
+    extrato_cache_evict(manifest, cache_folder)
+    extrato_manifest_save(cache_folder, manifest)
+    return manifest
+
+
+@instrumented()
+def load_extrato_diario_range(start, end, folder_path=EXTRATO_FOLDER, recursive=True, lowercase=True,
+                              cache_folder=EXTRATO_CACHE_FOLDER):
+    # Statement lines paid in [start, end). Files are picked by the payment range of their cache manifest entry
+    # (run extrato_cache_refresh first: nothing is written here, so concurrent processes can share the cache) and
+    # files missing from the manifest are parsed without caching
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    manifest = extrato_manifest_load(cache_folder)
+    tables = []
+    for file_path in extrato_files(folder_path, recursive):
+        entry = manifest.get(file_path)
+        if entry is None or not extrato_cache_fresh(entry, os.stat(file_path), cache_folder):
+            table = read_extrato_csv(file_path, lowercase=False)
+        elif entry['paid_from'] is not None and (pd.Timestamp(entry['paid_to']) < start or
+                                                 pd.Timestamp(entry['paid_from']) >= end):
+            continue
+        else:
+            table = feather.read_table(os.path.join(cache_folder, entry['cache_file']))
+        column = extrato_payment_column(table)
+        if column is None:
+            continue
+        dates = table.column(column)
+        table = table.filter(pc.fill_null(pc.and_(pc.greater_equal(dates, pa.scalar(start, dates.type)),
+                                                  pc.less(dates, pa.scalar(end, dates.type))), False))
+        tables.append(table.rename_columns([name.lower() for name in table.column_names]) if lowercase else table)
+    if not tables:
+        return pd.DataFrame(columns=list(EXTRATO_COLUMN_TYPES))
+    return pa.concat_tables(tables, promote_options='permissive').to_pandas()
@@ -0,0 +1,169 @@
+import argparse
+import json
+import sys
+
+# Command line entry point:
+#   financial_check.py sync     fetch payables / transactions / sales from the DB into the local cache
+#   financial_check.py check    payables checks (ReconciliationEngine rules) over the cached tables
+#   financial_check.py extrato  sales <-> extrato diario reconciliation
+#   financial_check.py reconcile  payables checks of the transactions changed since the last run only, kept in the
+#                                 discrepancy store (see discrepancies)
+# Checks read the local cache unless --refresh is given. Modules (and with them pandas, SQLAlchemy, pyarrow, duckdb)
+# are imported by the command that needs them.
+
+CHECKS = ['single_occurancy', 'refund', 'chargeback', 'payables_refund_reversal']
+SYNC_MODES = ['incremental', 'stream', 'bulk']
+# Cache read by each sync mode: incremental sync keeps the monthly parquet store, the others the feather files
+SYNC_SOURCES = {'incremental': 'parquet', 'stream': 'feather', 'bulk': 'feather'}
+
+
+def sync(mode):
+    import pagarme_check
+    if mode == 'incremental':
+        # Only rows changed since the last sync, merged into the monthly parquet store
+        return pagarme_check.db_sync()
+    if mode == 'stream':
+        # Only the needed columns, in chunks straight into the feather files
+        pagarme_check.db_bulk_stream()
+        return None
+    df_payables, df_transactions, df_sales = pagarme_check.db_bulk_load()
+    # Eliminate problem columns
+    df_transactions = df_transactions.drop(columns=['pagarme_transactions_created_at',
+                                                    'pagarme_transactions_updated_at'], errors='ignore')
+    pagarme_check.local_df_save({'pagarme_payables': df_payables, 'pagarme_transactions': df_transactions,
+                                 'pagarme_sales': df_sales})
+    return None
+
+
+def load_cached(file_names, source):
+    import pagarme_check
+    if source == 'parquet':
+        return pagarme_check.local_store_load(file_names)
+    return pagarme_check.local_df_load(file_names)
+
+
+def summarize(results):
+    # Number of flagged ids of every result list (counts are kept as they are)
+    return {name: [len(value) if isinstance(value, list) else value for value in
+                   (result if isinstance(result, tuple) else (result,))] for name, result in results.items()}
+
+
+def command_sync(args):
+    sync(args.mode)
+
+
+def command_check(args):
+    source = args.source
+    if args.refresh:
+        sync(args.refresh_mode)
+        source = SYNC_SOURCES[args.refresh_mode]
+    if args.backend == 'duckdb':
+        from duckdb_check import duckdb_reconciliation
+        results = duckdb_reconciliation(args.checks, parquet_store=source == 'parquet')
+    else:
+        import pagarme_check
+        # Transactions are only read by single_occurancy
+        file_names = ['pagarme_payables', 'pagarme_sales'] + \
+                     (['pagarme_transactions'] if 'single_occurancy' in args.checks else [])
+        frames = dict(zip(file_names, load_cached(file_names, source)))
+        if args.sum_by_month:
+            pagarme_check.check_sum_by_month(frames['pagarme_sales'].copy())
+        df_transactions = frames.get('pagarme_transactions')
+        results = pagarme_check.ReconciliationEngine(
+            pagarme_check.payables_adjust(frames['pagarme_payables']),
+            None if df_transactions is None else pagarme_check.transactions_adjust(df_transactions),
+            pagarme_check.sales_adjust(frames['pagarme_sales'])).run(args.checks)
+    for name, counts in summarize(results).items():
+        print(name, counts)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=lambda value: None)
+
+
+def command_extrato(args):
+    import pagarme_validation
+    if args.refresh:
+        # Refreshes the cache that is read next: the feather file, or the sales of the parquet store
+        import pagarme_check
+        if args.source == 'parquet':
+            pagarme_check.db_sync_table('pagarme_sales')
+        else:
+            pagarme_check.db_stream_save(pagarme_check.sales_query(", ".join(pagarme_check.SALES_COLUMNS)),
+                                         'pagarme_sales')
+    if not args.by_month:
+        [df_sales] = load_cached(['pagarme_sales'], args.source)
+        pagarme_validation.extrato_check(df_sales)
+        return
+    # Every worker reads its own month of the cache
+    df_report = pagarme_validation.extrato_check_by_month(args.source, args.start, args.end, args.workers)
+    pagarme_validation.local_df_save({'extrato_report': df_report})
+    print(df_report.to_string(index=False))
+
+
+def command_reconcile(args):
+    from discrepancies import reconcile_incremental
+    if args.refresh:
+        sync('incremental')
+    df_store, checked = reconcile_incremental(args.checks, args.full)
+    print('Transactions checked:', checked)
+    print(df_store[df_store['open']].groupby('issue').size().to_string())
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='financial_check', description='Pagar.me reconciliation checks')
+    parser.add_argument('--profile-stage', help='run this stage under cProfile (see instrumentation)')
+    parser.add_argument('--no-report', action='store_true', help='do not save the run report')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('sync', help='fetch the tables from the DB into the local cache')
+    command.add_argument('--mode', choices=SYNC_MODES, default='incremental',
+                         help='incremental: changed rows into the parquet store; stream / bulk: feather files')
+    command.set_defaults(run=command_sync)
+
+    command = commands.add_parser('check', help='payables checks over the cached tables')
+    command.add_argument('--checks', nargs='+', choices=CHECKS, default=CHECKS)
+    command.add_argument('--source', choices=['feather', 'parquet'], default='feather',
+                         help='cache to read: feather files or the monthly parquet store')
+    command.add_argument('--refresh', action='store_true', help='sync from the DB before checking')
+    command.add_argument('--refresh-mode', choices=SYNC_MODES, default='stream')
+    command.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                         help='duckdb runs the checks out of core over the cache')
+    command.add_argument('--sum-by-month', action='store_true', help='also compare monthly sales sums with extrato')
+    command.add_argument('--output', help='json file with the flagged transaction ids')
+    command.set_defaults(run=command_check)
+
+    command = commands.add_parser('extrato', help='sales <-> extrato diario reconciliation')
+    command.add_argument('--source', choices=['feather', 'parquet'], default='feather')
+    command.add_argument('--refresh', action='store_true',
+                         help='fetch the sales of --source from the DB before checking')
+    command.add_argument('--by-month', action='store_true',
+                         help='cash basis, one worker process per month, with a report')
+    command.add_argument('--start', default='2023-01-01', help='first cash date (by month only)')
+    command.add_argument('--end', default='2024-01-01', help='end cash date, exclusive (by month only)')
+    command.add_argument('--workers', type=int)
+    command.set_defaults(run=command_extrato)
+
+    command = commands.add_parser('reconcile', help='re-check only the transactions changed since the last run')
+    command.add_argument('--checks', nargs='+', choices=CHECKS, default=CHECKS)
+    command.add_argument('--refresh', action='store_true', help='incremental sync from the DB before checking')
+    command.add_argument('--full', action='store_true', help='re-check every transaction of the parquet store')
+    command.set_defaults(run=command_reconcile)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.no_report:
+        return args.run(args)
+    from instrumentation import finish_run, start_run
+    start_run(args.command, args.profile_stage)
+    try:
+        args.run(args)
+    finally:
+        report, report_path = finish_run()
+        print(report.to_frame().drop(columns=['started_at', 'profile']).to_string(index=False), file=sys.stderr)
+        print('Run report saved to', report_path + '.json', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+try:
+    import resource
+except ImportError:
+    # Windows: no getrusage, peak RSS is only read from /proc on Linux
+    resource = None
+
+load_dotenv()
+
+# Pipeline instrumentation: stages (context manager or decorator) record wall time, CPU time, peak RSS and rows
+# in / out into the active run report, saved as json and parquet in RUN_REPORT_FOLDER. Outside a run, stages
+# only call through. PROFILE_STAGE (or start_run(profile_stage=...)) runs that stage under cProfile.
+
+RUN_REPORT_FOLDER = os.environ.get("RUN_REPORT_FOLDER", 'run_reports')
+
+_current_run = None
+_run_lock = threading.Lock()
+
+
+def rss_peak_mb():
+    # Peak resident memory of the process since the last reset (VmHWM), or since start without /proc
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 1024)
+
+
+def rss_peak_reset():
+    # Linux: writing 5 to clear_refs restarts VmHWM from the current RSS, so each stage gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def count_rows(value):
+    # Rows of a frame, or of the frames in a tuple / list / dict result (None when there are none)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        rows = [count_rows(item) for item in value if isinstance(item, (pd.DataFrame, pd.Series))]
+        return sum(rows) if rows else None
+    return None
+
+
+class RunReport:
+
+    def __init__(self, name, profile_stage=None, folder=RUN_REPORT_FOLDER):
+        self.name = name
+        self.profile_stage = profile_stage
+        self.folder = folder
+        self.started_at = pd.Timestamp.now()
+        self.stages = []
+        # Open stages, innermost last: a nested stage resets the RSS peak, so it is folded into the outer ones first
+        self._open = []
+        # Peak of the whole run: every stage resets the RSS peak, so the maximum of all readings is kept
+        self.rss_peak_mb = None
+
+    def _fold_rss_peak(self):
+        peak = rss_peak_mb()
+        if peak is None:
+            return
+        self.rss_peak_mb = max(self.rss_peak_mb or 0, peak)
+        for record in self._open:
+            record['rss_peak_mb'] = max(record['rss_peak_mb'] or 0, peak)
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        # The yielded record is updated in place, e.g. record['rows_out'] = len(df)
+        record = {'stage': name, 'parent': self._open[-1]['stage'] if self._open else None, 'rows_in': rows_in,
+                  'rows_out': None, 'started_at': pd.Timestamp.now().isoformat(), 'wall_seconds': None,
+                  'cpu_seconds': None, 'rss_peak_mb': None, 'profile': None}
+        self._fold_rss_peak()
+        rss_peak_reset()
+        self._open.append(record)
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            self._fold_rss_peak()
+            self._open.pop()
+            self.stages.append(record)
+            if profiler is not None:
+                record['profile'] = self.save_profile(name, profiler)
+
+    def save_profile(self, name, profiler):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, self.file_prefix() + '_' + name + '.prof')
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        return path
+
+    def file_prefix(self):
+        return self.name + '_' + self.started_at.strftime('%Y%m%d_%H%M%S')
+
+    def to_frame(self):
+        return pd.DataFrame(self.stages, columns=['stage', 'parent', 'rows_in', 'rows_out', 'started_at',
+                                                  'wall_seconds', 'cpu_seconds', 'rss_peak_mb', 'profile'])
+
+    def save(self):
+        # <folder>/<run>_<YYYYmmdd_HHMMSS>.json and .parquet with one row per stage
+        self._fold_rss_peak()
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, self.file_prefix())
+        with open(path + '.json', 'w') as f:
+            json.dump({'run': self.name, 'started_at': self.started_at.isoformat(),
+                       'finished_at': pd.Timestamp.now().isoformat(), 'rss_peak_mb': self.rss_peak_mb,
+                       'stages': self.stages}, f, indent=2, default=str)
+        self.to_frame().to_parquet(path + '.parquet', index=False)
+        return path
+
+
+def start_run(name, profile_stage=None, folder=RUN_REPORT_FOLDER):
+    global _current_run
+    with _run_lock:
+        _current_run = RunReport(name, profile_stage or os.environ.get("PROFILE_STAGE"), folder)
+    return _current_run
+
+
+def finish_run():
+    # Saves the active run report and returns it with its file path
+    global _current_run
+    with _run_lock:
+        report, _current_run = _current_run, None
+    if report is None:
+        return None, None
+    return report, report.save()
+
+
+def current_run():
+    return _current_run
+
+
+@contextmanager
+def paused():
+    # Nothing inside is recorded (e.g. a tracemalloc pass whose overhead would distort the run report)
+    global _current_run
+    report, _current_run = _current_run, None
+    try:
+        yield
+    finally:
+        _current_run = report
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    # Stage of the active run (a plain dict record outside a run, so callers can always set rows_out)
+    # Stages opened from worker threads are not recorded: the open stage stack is per run, not per thread
+    report = _current_run
+    if report is None or threading.current_thread() is not threading.main_thread():
+        yield {}
+        return
+    with report.stage(name, rows_in) as record:
+        yield record
+
+
+def instrumented(name=None):
+    # Decorator: the function runs as a stage named after it, rows in / out counted from frame arguments and result
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current_run is None:
+                return function(*args, **kwargs)
+            with stage(stage_name, count_rows(list(args) + list(kwargs.values()))) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+# Amounts are kept as exact integer cents (nullable Int64) from ingestion on: sums and comparisons between
+# sales, payables and extrato are integer math without tolerances
+
+
+def to_cents(values):
+    # Reais (numbers, Decimal or numeric strings) to integer cents; rounding removes binary float noise
+    reais = pd.to_numeric(values).astype('float64')
+    return pd.Series(np.round(reais.to_numpy() * 100), index=values.index, name=values.name).astype('Int64')
+
+
+def from_cents(values):
+    # Integer cents back to reais, for reports
+    return values.astype('float64') / 100
+
+
+def nonzero_cents(values):
+    # Boolean mask of amounts (or amount differences) that are present and not zero
+    return (values.notna() & values.ne(0)).to_numpy(bool)
@@ -1,234 +1,601 @@
 import json
+import numpy as np
 import os
 import pandas as pd
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from dotenv import load_dotenv
-from mysql.connector import connect, Error
-from sqlalchemy import create_engine, text
+
+from database import db_engine
+from instrumentation import instrumented, stage
+from money import nonzero_cents, to_cents
+from schema import split_gateway_id, to_date, to_id, to_installment, to_status
 
 load_dotenv()
 
-load_from_DB = True
+# SQLAlchemy, pyarrow and the DB driver are imported by the functions that need them: checks run from the local
+# cache (financial_check.py check) start without loading them
+
+# Rows fetched per round trip when streaming tables from the DB
+STREAM_CHUNKSIZE = 100000
+# Only the columns used by the checks (and by pagarme_validation) are selected when streaming
+PAYABLES_COLUMNS = ['transaction_id', 'installment', 'amount', 'type', 'data_de_competencia']
+TRANSACTIONS_COLUMNS = ['transaction_id', 'installments', 'status', 'nsu']
+SALES_COLUMNS = ['gateway_id', 'data_venda', 'cpf_responsavel_compra', 'status', 'valor_parcela_total',
+                 'valor_total_venda', 'valor_taxa_total', 'valor_cancelamento', 'reembolso_taxa', 'juros_atraso',
+                 'recebimento_financiamento', 'efetivacao_cancelamento']
+# Incremental sync: row key, high-water mark column and month partition column (None: single partition)
+SYNC_TABLES = {
+    'pagarme_payables': {'columns': PAYABLES_COLUMNS, 'key': 'id', 'watermark': 'pagarme_payables_updated_at',
+                         'partition': 'data_de_competencia'},
+    'pagarme_transactions': {'columns': TRANSACTIONS_COLUMNS, 'key': 'transaction_id',
+                             'watermark': 'pagarme_transactions_updated_at', 'partition': None},
+    'pagarme_sales': {'columns': SALES_COLUMNS, 'key': 'id', 'watermark': 'updated_at',
+                      'partition': 'recebimento_financiamento'},
+}
 
 
 def db_load(query):
+    from mysql.connector import Error
     try:
-        # create sqlalchemy engine
-        engine = create_engine("mysql+pymysql://{user}:{pw}@{ep}:{port}/{db}"
-                               .format(user=os.environ.get("DATABASE_USER"),
-                                       pw=os.environ.get("DATABASE_PASS"),
-                                       ep=os.environ.get("DATABASE_HOST"),
-                                       port=os.environ.get("DATABASE_PORT"),
-                                       db=os.environ.get("DATABASE_NAME")))
+        engine = db_engine()
         df_retrieved = pd.read_sql(query, engine)
         return df_retrieved
     except Error as err:
         return -1, err
 
 
-def db_bulk_load():
-    payables = db_load("SELECT * FROM pagarme_payables")
-    transactions = db_load("SELECT * FROM pagarme_transactions")
+def sales_query(columns='*'):
     if os.environ.get("DATABASE_NAME") == 'dnc_sales':
-        sales = db_load("SELECT * from pagarme_sales_corrigido WHERE gateway_name = 'Pagarme'")
-    else:
-        sales = db_load("SELECT * from sales WHERE gateway_name = 'pagarme'")
+        return "SELECT " + columns + " from pagarme_sales_corrigido WHERE gateway_name = 'Pagarme'"
+    return "SELECT " + columns + " from sales WHERE gateway_name = 'pagarme'"
+
+
+@instrumented()
+def db_bulk_load(parallel=True):
+    queries = ["SELECT * FROM pagarme_payables", "SELECT * FROM pagarme_transactions", sales_query()]
+    if not parallel:
+        return tuple(db_load(query) for query in queries)
+    # Each table is read on its own pooled connection: total time is close to the slowest table
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        payables, transactions, sales = executor.map(db_load, queries)
     return payables, transactions, sales
 
 
+def db_stream_load(query, chunksize=STREAM_CHUNKSIZE, params=None):
+    import pyarrow as pa
+    from sqlalchemy import text
+    # Server side cursor: MySQL sends the result chunk by chunk instead of buffering the whole table
+    with db_engine().connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(text(query), conn, chunksize=chunksize, params=params):
+            yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+
+def db_stream_save(query, file_name, chunksize=STREAM_CHUNKSIZE):
+    import pyarrow as pa
+    # Write every arrow batch straight into the feather file, so only one chunk is held in memory
+    writer = None
+    try:
+        for batch in db_stream_load(query, chunksize):
+            if writer is None:
+                # Columns that are all null in the first chunk cannot be typed yet: keep them as strings
+                schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                    for field in batch.schema])
+                writer = pa.ipc.new_file(local_df_path(file_name), schema,
+                                         options=pa.ipc.IpcWriteOptions(compression='lz4'))
+            # Chunks may infer other types (e.g. int -> float when a chunk has NULLs): align to the file schema
+            writer.write_table(pa.Table.from_batches([batch]).cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+@instrumented()
+def db_bulk_stream(chunksize=STREAM_CHUNKSIZE, parallel=True):
+    streams = {'pagarme_payables': "SELECT " + ", ".join(PAYABLES_COLUMNS) + " FROM pagarme_payables",
+               'pagarme_transactions': "SELECT " + ", ".join(TRANSACTIONS_COLUMNS) + " FROM pagarme_transactions",
+               'pagarme_sales': sales_query(", ".join(SALES_COLUMNS))}
+    with ThreadPoolExecutor(max_workers=len(streams) if parallel else 1) as executor:
+        futures = [executor.submit(db_stream_save, query, file_name, chunksize) for file_name, query in streams.items()]
+        for future in futures:
+            future.result()
+
+
+def sync_query(file_name, mark):
+    config = SYNC_TABLES[file_name]
+    columns = [config['key'], config['watermark']] + [c for c in config['columns']
+                                                       if c not in (config['key'], config['watermark'])]
+    if file_name == 'pagarme_sales':
+        query = sales_query(", ".join(columns))
+        condition = " AND "
+    else:
+        query = "SELECT " + ", ".join(columns) + " FROM " + file_name
+        condition = " WHERE "
+    if mark is None:
+        return query
+    if mark['key'] is None:
+        # Mark saved without its key: the rows at its time are fetched again once
+        return query + condition + config['watermark'] + " >= :mark_value"
+    # Compound mark: only rows after the last synced (time, key), so rows sharing the mark time are not fetched
+    # again while rows committed later with that time and a greater key still are
+    return query + condition + "(" + config['watermark'] + " > :mark_value OR (" + config['watermark'] + \
+        " = :mark_value AND " + config['key'] + " > :mark_key))"
+
+
+def sync_mark(df, file_name, mark=None):
+    # Last (watermark, key) of the rows, or mark when it is later
+    config = SYNC_TABLES[file_name]
+    values = df[config['watermark']].dropna()
+    if values.empty:
+        return mark
+    last = values.max()
+    df_mark = (last, df.loc[values.index[values == last], config['key']].max())
+    return df_mark if mark is None or df_mark > mark else mark
+
+
+def sync_mark_load(file_name):
+    # High-water mark of a table as {'value': watermark, 'key': key} (marks of older versions only had the value)
+    with sync_state_lock:
+        mark = sync_state_load().get(file_name)
+    return {'value': mark, 'key': None} if isinstance(mark, str) else mark
+
+
+def db_sync_table(file_name, chunksize=STREAM_CHUNKSIZE):
+    import shutil
+    config = SYNC_TABLES[file_name]
+    # Only rows created or updated after the last high-water mark are fetched
+    mark = sync_mark_load(file_name)
+    params = None if mark is None else {'mark_value': mark['value'], 'mark_key': mark['key']}
+    # Every chunk is spilled by month as it arrives: only one chunk and the keys / transaction ids of the synced
+    # rows are held in memory, also on the first sync of the whole history
+    spill_path = sync_spill_path(file_name)
+    shutil.rmtree(spill_path, ignore_errors=True)
+    keys, transaction_ids, new_mark = [], [], None
+    for i, batch in enumerate(db_stream_load(sync_query(file_name, mark), chunksize, params)):
+        chunk = batch.to_pandas()
+        if file_name == 'pagarme_sales':
+            # Sales rows also keep their transaction_id, so store reads can filter on it
+            chunk['transaction_id'] = split_gateway_id(chunk['gateway_id'])[1]
+        spill_save(spill_path, chunk, local_store_month(chunk, file_name), i)
+        keys.append(chunk[config['key']])
+        transaction_ids.append(store_transaction_ids(chunk, file_name).dropna().drop_duplicates())
+        new_mark = sync_mark(chunk, file_name, new_mark)
+    delta_keys = pd.Index(pd.concat(keys).unique()) if keys else pd.Index([])
+    if delta_keys.empty:
+        return 0
+    sync_changes_save(file_name, pd.concat(transaction_ids))
+    local_store_merge(file_name, spill_path, delta_keys)
+    shutil.rmtree(spill_path)
+    # Record the new high-water mark only after the store has been written
+    if new_mark is not None:
+        value, key = new_mark
+        with sync_state_lock:
+            state = sync_state_load()
+            state[file_name] = {'value': str(value), 'key': key.item() if hasattr(key, 'item') else key}
+            sync_state_save(state)
+    return len(delta_keys)
+
+
+@instrumented()
+def db_sync(chunksize=STREAM_CHUNKSIZE, parallel=True):
+    # Returns the number of synced rows of every table, keyed by local file name
+    with ThreadPoolExecutor(max_workers=len(SYNC_TABLES) if parallel else 1) as executor:
+        futures = {file_name: executor.submit(db_sync_table, file_name, chunksize) for file_name in SYNC_TABLES}
+    return {file_name: future.result() for file_name, future in futures.items()}
+
+
+# Tables are synced concurrently but share one state file
+sync_state_lock = threading.Lock()
+
+
+def sync_state_path():
+    return os.environ.get("DATABASE_NAME") + "_sync_state.json"
+
+
+def sync_state_load():
+    if not os.path.exists(sync_state_path()):
+        return {}
+    with open(sync_state_path()) as f:
+        return json.load(f)
+
+
+def sync_state_save(state):
+    # Written aside and renamed, so a reader never sees a partially written file
+    with open(sync_state_path() + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(sync_state_path() + '.tmp', sync_state_path())
+
+
+def local_store_path(file_name):
+    return os.environ.get("DATABASE_NAME") + "_" + file_name
+
+
+def store_transaction_ids(df, file_name):
+    # Sales are keyed by gateway_id ("<installment>-<transaction_id>"), the other tables by transaction_id
+    if file_name == 'pagarme_sales':
+        return split_gateway_id(df['gateway_id'])[1]
+    return to_id(df['transaction_id'])
+
+
+def sync_changes_path(file_name):
+    return local_store_path(file_name) + "_changes"
+
+
+def sync_change_files(file_name):
+    # Change files of the incremental sync, oldest first
+    if not os.path.exists(sync_changes_path(file_name)):
+        return []
+    return sorted(file for file in os.listdir(sync_changes_path(file_name)) if file.endswith('.parquet'))
+
+
+def sync_changes_save(file_name, transaction_ids):
+    # Change log: the transaction ids of every synced delta, one file per sync named by its time
+    # (<DATABASE_NAME>_<table>_changes/<ns>.parquet), written before the store so no change is left out
+    os.makedirs(sync_changes_path(file_name), exist_ok=True)
+    change_file = os.path.join(sync_changes_path(file_name), '%020d.parquet' % time.time_ns())
+    pd.DataFrame({'transaction_id': pd.array(transaction_ids.unique(), dtype='Int64')}).\
+        to_parquet(change_file + '.tmp', index=False)
+    os.replace(change_file + '.tmp', change_file)
+
+
+def sync_spill_path(file_name):
+    return local_store_path(file_name) + "_sync"
+
+
+def spill_save(spill_path, chunk, chunk_month, chunk_number):
+    # Rows of a chunk by month: <spill_path>/month=YYYY-MM/<chunk_number>.parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    for month, rows in chunk.groupby(chunk_month):
+        os.makedirs(os.path.join(spill_path, 'month=' + month), exist_ok=True)
+        pq.write_table(pa.Table.from_pandas(rows, preserve_index=False),
+                       os.path.join(spill_path, 'month=' + month, '%06d.parquet' % chunk_number))
+
+
+def spill_load(spill_path, partition):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # Chunks may have other types (e.g. int -> float when a chunk has NULLs): promoted to a common schema
+    month_path = os.path.join(spill_path, partition)
+    return pa.concat_tables([pq.read_table(os.path.join(month_path, chunk_file))
+                             for chunk_file in sorted(os.listdir(month_path))],
+                            promote_options='permissive').to_pandas()
+
+
+def local_store_month(df, file_name):
+    partition = SYNC_TABLES[file_name]['partition']
+    if partition is None:
+        return pd.Series('all', index=df.index)
+    return pd.to_datetime(df[partition], errors='coerce').dt.strftime('%Y-%m').fillna('none')
+
+
+def local_store_merge(file_name, spill_path, delta_keys):
+    import pyarrow.parquet as pq
+    # Monthly partitions: <DATABASE_NAME>_<table>/month=YYYY-MM/data.parquet, rewritten one at a time from their
+    # spilled rows (see spill_save) and their rows whose key was not synced again
+    key = SYNC_TABLES[file_name]['key']
+    store_path = local_store_path(file_name)
+    os.makedirs(store_path, exist_ok=True)
+    spilled = set(os.listdir(spill_path))
+    for partition in sorted(set(os.listdir(store_path)) | spilled):
+        partition_file = os.path.join(store_path, partition, 'data.parquet')
+        frames = [spill_load(spill_path, partition)] if partition in spilled else []
+        if os.path.exists(partition_file):
+            # Skip partitions that neither receive rows nor hold an old version of an updated row
+            old_keys = pq.read_table(partition_file, columns=[key]).column(key).to_pandas()
+            if not frames and not old_keys.isin(delta_keys).any():
+                continue
+            old_rows = pd.read_parquet(partition_file)
+            frames.insert(0, old_rows[~old_rows[key].isin(delta_keys)])
+        if not frames:
+            continue
+        os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+        pd.concat(frames, ignore_index=True).to_parquet(partition_file + '.tmp', index=False)
+        os.replace(partition_file + '.tmp', partition_file)
+
+
+@instrumented()
+def local_store_load(files2load):
+    df_loaded = []
+    for file_name in files2load:
+        store_path = local_store_path(file_name)
+        df = pd.concat([pd.read_parquet(os.path.join(store_path, partition, 'data.parquet'))
+                        for partition in sorted(os.listdir(store_path))], ignore_index=True)
+        # Sync bookkeeping columns are not part of the cached table
+        config = SYNC_TABLES[file_name]
+        df_loaded.append(df[[c for c in df.columns if c in config['columns']]])
+    return df_loaded
+
+
+def local_df_path(file_name):
+    return os.environ.get("DATABASE_NAME") + "_" + file_name + ".feather"
+
+
+@instrumented()
 def local_df_save(dict2save):
     for file_name, df_name in dict2save.items():
-        df_name.to_feather(os.environ.get("DATABASE_NAME") + "_" + file_name + ".feather")
+        df_name.to_feather(local_df_path(file_name))
 
 
+@instrumented()
 def local_df_load(files2load):
     df_loaded = []
     for file_name in files2load:
-        df = pd.read_feather(os.environ.get("DATABASE_NAME") + "_" + file_name + ".feather")
+        df = pd.read_feather(local_df_path(file_name))
         df_loaded.append(df)
     return df_loaded
 
 
 def local_df_load_extrato_diario():
-    import os
-    import pandas as pd
-
-    # Directory containing the Excel files
-    folder_path = './extrato_diario'
-    # List to store DataFrames
-    dfs = []
-    # Iterate over files in the folder
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.csv'):
-            file_path = os.path.join(folder_path, filename)
-            # Read Excel file into DataFrame
-            df = pd.read_csv(file_path)
-            # Append DataFrame to list
-            dfs.append(df)
-    # Concatenate DataFrames vertically
-    combined_df = pd.concat(dfs, ignore_index=True)
-    return combined_df
+    from extrato import load_extrato_diario
+    return load_extrato_diario(recursive=False, lowercase=False)
 
 
+@instrumented()
 def payables_adjust(df):
-    # Adjust Date Format
-    string_format = "%Y-%m-%d"
-    df['data_de_competencia'] = df['data_de_competencia'].apply(lambda x: x.strftime(string_format))
-    # Select specific interest rows from table
-    df = df[['data_de_competencia', 'transaction_id', 'installment', 'amount', 'type']]
-    # Rename rows to match sales
-    df.rename(columns={'data_de_competencia': 'data_venda', 'amount': 'valor', 'type': 'status'}, inplace=True)
+    # Select specific interest rows from table and rename them to match sales
+    df = df[['data_de_competencia', 'transaction_id', 'installment', 'amount', 'type']].\
+        rename(columns={'data_de_competencia': 'data_venda', 'amount': 'valor', 'type': 'status'})
+    # Compact schema: dates, integer keys, categorical status and amounts as integer cents
+    df['data_venda'] = to_date(df['data_venda']).dt.normalize()
+    df['transaction_id'] = to_id(df['transaction_id'])
+    df['installment'] = to_installment(df['installment'])
+    df['status'] = to_status(df['status'])
+    df['valor'] = to_cents(df['valor'])
     df.sort_values(by=['data_venda', 'transaction_id', 'installment'], inplace=True)
     df.reset_index(drop=True, inplace=True)
-    df['data_venda'] = df['data_venda'].astype('string')
-    df['transaction_id'] = df['transaction_id'].astype('string')
     return df
 
 
+@instrumented()
 def sales_adjust(df):
+    # Select specific columns to work with and rename them to match other DB
+    df = df[['data_venda', 'gateway_id', 'cpf_responsavel_compra', 'valor_parcela_total', 'status',
+             'valor_cancelamento']].rename(columns={'valor_parcela_total': 'valor', 'valor_cancelamento': 'refund'})
     # Create columns with corresponding installment and transaction id
-    df['installment'] = df['gateway_id'].str.split('-').str[0]
-    df['transaction_id'] = df['gateway_id'].str.split('-').str[1]
-    # Select specific columns to work with
-    df = df[['data_venda', 'transaction_id', 'installment', 'cpf_responsavel_compra', 'valor_parcela_total', 'status',
-             'valor_cancelamento']]
-    # Rename Columns to match other DB
-    df.rename(columns={'valor_parcela_total': 'valor', 'valor_cancelamento': 'refund'}, inplace=True)
-    df['refund'].fillna(0, inplace=True)
-    # Dataframe specific column types
-    df['installment'] = df['installment'].astype('int64')
-    df['data_venda'] = df['data_venda'].astype('string')
-    df['transaction_id'] = df['transaction_id'].astype('string')
+    df['installment'], df['transaction_id'] = split_gateway_id(df.pop('gateway_id'))
+    # Dataframe specific column types (amounts as integer cents)
+    df['data_venda'] = to_date(df['data_venda'])
+    df['status'] = to_status(df['status'])
+    df['valor'] = to_cents(df['valor'])
+    df['refund'] = to_cents(df['refund'].fillna(0))
+    df = df[['data_venda', 'transaction_id', 'installment', 'cpf_responsavel_compra', 'valor', 'status', 'refund']]
     # Dataframe sort by column values
-    df.sort_values(by=['data_venda', 'transaction_id', 'installment'], inplace=True)
-    df.reset_index(drop=True, inplace=True)
+    df = df.sort_values(by=['data_venda', 'transaction_id', 'installment']).reset_index(drop=True)
     return df
 
 
-def check_single_occurancy(df_p, df_t, df_s):
-    # Get sub dataframe from payables where there is only one status per transaction id
-    df_p_unique_status = df_p.groupby('transaction_id').filter(lambda x: x['status'].nunique() == 1)
+@instrumented()
+def transactions_adjust(df):
+    # Same key types as payables and sales (other columns are kept for reporting)
+    df['transaction_id'] = to_id(df['transaction_id'])
+    df['installments'] = to_installment(df['installments'])
+    df['status'] = to_status(df['status'])
+    return df
+
+
+def status_signature(df_p):
+    # One bit per status and one more for a missing status: a transaction signature is the OR of the bits of all
+    # its payables statuses
+    status = to_status(df_p['status'])
+    status_bits = {status: 1 << bit for bit, status in enumerate(status.cat.categories)}
+    missing_bit = 1 << len(status_bits)
+    codes = status.cat.codes.to_numpy().astype('int64')
+    df_bits = pd.DataFrame({'transaction_id': df_p['transaction_id'],
+                            'bit': np.where(codes >= 0, np.left_shift(1, np.maximum(codes, 0)), missing_bit)}).\
+        drop_duplicates()
+    # Bits are distinct after drop_duplicates, so their sum is the OR
+    signature = df_bits.groupby('transaction_id')['bit'].sum()
+    # Signature of the transaction of each payables row (0 when transaction_id is missing)
+    return df_p['transaction_id'].map(signature).fillna(0).astype('int64'), status_bits, missing_bit
+
+
+def status_set_mask(status_bits, statuses):
+    # Signature of a transaction holding exactly these statuses (-1 never matches when one status never occurs)
+    if any(status not in status_bits for status in statuses):
+        return -1
+    return sum(status_bits[status] for status in statuses)
+
+
+class ReconciliationEngine:
+    # Shared index over adjusted payables / transactions / sales: join keys, per transaction and per
+    # (transaction_id, installment) sums and status sets are built lazily once and read by every rule.
+    # Rules are functions rule(engine) -> result and never modify the frames.
+
+    def __init__(self, df_p, df_t=None, df_s=None):
+        self.df_p = df_p
+        self.df_t = df_t
+        self.df_s = df_s
+        self.rules = dict(RECONCILIATION_RULES)
+
+    def register(self, name, rule):
+        self.rules[name] = rule
+
+    def evaluate(self, name):
+        with stage('rule_' + name):
+            return self.rules[name](self)
+
+    def run(self, names=None):
+        return {name: self.evaluate(name) for name in (self.rules if names is None else names)}
+
+    @cached_property
+    def status_sig(self):
+        return status_signature(self.df_p)
+
+    @cached_property
+    def status_ids(self):
+        # Unique transaction ids of each payables status, in payables order
+        return {status: pd.Index(ids.unique()) for status, ids in
+                self.df_p.groupby('status', sort=False, observed=True)['transaction_id']}
+
+    def ids_with_status(self, status):
+        return self.status_ids.get(status, pd.Index([], dtype=self.df_p['transaction_id'].dtype))
+
+    @cached_property
+    def p_sum(self):
+        # Payables valor sum per transaction
+        return self.df_p.groupby('transaction_id')['valor'].sum()
+
+    @cached_property
+    def s_sum(self):
+        # Sales valor + refund per transaction (integer cents)
+        s_group = self.df_s.groupby('transaction_id')
+        return s_group['valor'].sum() + s_group['refund'].sum()
+
+    @cached_property
+    def s_installment(self):
+        # Sales per (transaction_id, installment) key: valor range, missing valor and refund presence
+        sales = self.df_s[['transaction_id', 'installment', 'valor']].assign(
+            valor_na=self.df_s['valor'].isna(), refund_nonzero=(self.df_s['refund'].fillna(0) != 0).astype(bool))
+        return sales.groupby(['transaction_id', 'installment']).agg(valor_min=('valor', 'min'),
+                                                                     valor_max=('valor', 'max'),
+                                                                     valor_na=('valor_na', 'any'),
+                                                                     refund_nonzero=('refund_nonzero', 'any'))
+
+    def s_installment_of(self, df):
+        # Sales aggregates aligned to the rows of a payables subframe (NA when the key has no sales)
+        # Nullable boolean flags: reindex would turn the bool columns into object ones
+        return self.s_installment.astype({'valor_na': 'boolean', 'refund_nonzero': 'boolean'}).\
+            reindex(pd.MultiIndex.from_frame(df[['transaction_id', 'installment']]))
+
+
+def rule_single_occurancy(engine):
+    df_p, df_t = engine.df_p, engine.df_t
+    signature, _, missing_bit = engine.status_sig
+    # Get sub dataframe from payables where there is only one status per transaction id (single bit signature,
+    # missing statuses not counted)
+    known = signature & ~missing_bit
+    df_p_unique_status = df_p[(known > 0) & ((known & (known - 1)) == 0)]
     # Invalid payables: status != 'credit' with unique id  =>  These values are not present on sales DB
     invalid_unique_st_status = df_p_unique_status[df_p_unique_status['status'] != 'credit']['transaction_id'].unique().tolist()
 
-    # Check within unique ids (status == credit) the number of installments
-    df_t['installments'].fillna(1, inplace=True)
     # Filter df_p_unique_status for status == 'credit'
     df_p_credit = df_p_unique_status[df_p_unique_status['status'] == 'credit']
-    # Group df_p_credit by 'transaction_id' and count the number of rows for each group
-    installments_count = df_p_credit.groupby('transaction_id').size().rename('installments')
-    # Merge installments_count with df_t on 'transaction_id'
-    merged_df = pd.merge(df_t[df_t['transaction_id'].isin(df_p_credit['transaction_id'])], installments_count,
-                         left_on='transaction_id', right_index=True, how='left')
-    # Filter rows where installments from df_t don't match installments from groupby
-    invalid_unique_st_installments = merged_df[merged_df['installments_x'] != merged_df['installments_y']]['transaction_id'].unique().tolist()
+    # Count the number of credit rows for each transaction
+    installments_count = df_p_credit.groupby('transaction_id').size()
+    # Installments from transactions (missing means a single installment) that don't match the credit rows
+    df_t_credit = df_t[df_t['transaction_id'].isin(installments_count.index)]
+    installments_mismatch = df_t_credit['installments'].fillna(1).to_numpy() != \
+                            installments_count.reindex(df_t_credit['transaction_id']).to_numpy()
+    invalid_unique_st_installments = df_t_credit[installments_mismatch]['transaction_id'].unique().tolist()
 
     # Make comparison with sales DB
-    df_p_vs_s = df_p_credit.merge(df_s, on=['transaction_id', 'installment'], how='left', suffixes=('_p', '_s'))
-    df_p_vs_s['refund'].fillna(0, inplace=True)
+    s_credit = engine.s_installment_of(df_p_credit)
+    credit_ids = df_p_credit['transaction_id']
     # Check if there is any refund value within sales => not expected
-    invalid_unique_st_s_refund = df_p_vs_s[df_p_vs_s['refund'] != 0]['transaction_id'].unique().tolist()
+    invalid_unique_st_s_refund = credit_ids[s_credit['refund_nonzero'].fillna(False).to_numpy(bool)].unique().tolist()
     # Check missing values within sales that are present within payables
-    invalid_unique_st_missing_s = df_p_vs_s[df_p_vs_s['valor_s'].isna()]['transaction_id'].unique().tolist()
-    # Check discrepancies between sales and payables values
-    df_p_vs_s.dropna(subset=['valor_s'], inplace=True)
-    df_p_vs_s['delta_v'] = df_p_vs_s['valor_s'] - df_p_vs_s['valor_p']
-    invalid_unique_st_valuesDiff = df_p_vs_s[df_p_vs_s['delta_v'].abs() > .01]['transaction_id'].unique().tolist()
+    invalid_unique_st_missing_s = credit_ids[s_credit['valor_na'].fillna(True).to_numpy(bool)].unique().tolist()
+    # Check discrepancies between sales and payables values (any sales row of the key with another amount)
+    valor_p = df_p_credit['valor'].array
+    values_diff = nonzero_cents(pd.Series(s_credit['valor_max'].array - valor_p)) | \
+                  nonzero_cents(pd.Series(s_credit['valor_min'].array - valor_p))
+    invalid_unique_st_valuesDiff = credit_ids[values_diff].unique().tolist()
 
     return invalid_unique_st_status, invalid_unique_st_installments, invalid_unique_st_s_refund, \
            invalid_unique_st_missing_s, invalid_unique_st_valuesDiff
 
 
-def check_refund(df_p, df_s):
-    # Get subframe from payables containing only status credit and refund
-    df_p_refund_only = df_p.groupby('transaction_id').filter(lambda x: set(x['status']) == {'credit', 'refund'})
-    p_refund_only_ids = df_p_refund_only['transaction_id'].unique().tolist()  # Get their transaction ids
-    # Get subframe from sales with such transaction ids
-    df_s_refund_only = df_s[df_s['transaction_id'].isin(p_refund_only_ids)]
-    s_refund_only_ids = df_s_refund_only['transaction_id'].unique().tolist()  # Get their transaction ids
+def rule_refund(engine):
+    signature, status_bits, _ = engine.status_sig
+    # Get transaction ids from payables containing only status credit and refund (none missing)
+    p_refund_only_ids = pd.Index(engine.df_p[signature == status_set_mask(status_bits, ['credit', 'refund'])]
+                                 ['transaction_id'].unique())
     # Check refunds id not present on sales and payables
-    invalid_refund_only_no_sales = list(set(p_refund_only_ids) - set(s_refund_only_ids))
+    with_sales = p_refund_only_ids.isin(engine.s_sum.index)
+    invalid_refund_only_no_sales = p_refund_only_ids[~with_sales].tolist()
     # Check sum discrepancy
-    df_p_refund_only_valid = df_p_refund_only[~df_p_refund_only['transaction_id'].isin(invalid_refund_only_no_sales)]
-    df_s_refund_only['refund'] = df_s_refund_only['refund'].astype(float)
-    s_refund_only_sum = df_s_refund_only.groupby('transaction_id')['valor'].sum() + \
-                        df_s_refund_only.groupby('transaction_id')['refund'].sum()
-    p_refund_only_valid_sum = df_p_refund_only_valid.groupby('transaction_id')['valor'].sum()
-    refund_p_vs_s_delta_sum = s_refund_only_sum - p_refund_only_valid_sum
-    invalid_refund_only_sum_error = refund_p_vs_s_delta_sum.index[refund_p_vs_s_delta_sum.abs() > .1].tolist()
+    refund_only_valid_ids = p_refund_only_ids[with_sales].sort_values()
+    refund_p_vs_s_delta_sum = engine.s_sum.reindex(refund_only_valid_ids) - engine.p_sum.reindex(refund_only_valid_ids)
+    invalid_refund_only_sum_error = refund_only_valid_ids[nonzero_cents(refund_p_vs_s_delta_sum)].tolist()
     return invalid_refund_only_no_sales, invalid_refund_only_sum_error
 
 
-def check_chargeback(df_p, df_s):
-    # chargeback list ids
-    list_chargeback = df_p[df_p['status'] == 'chargeback']['transaction_id'].unique()
+def rule_chargeback(engine):
+    # chargeback list ids (pd.Index: membership tests below are hash lookups keeping the ids order)
+    list_chargeback = engine.ids_with_status('chargeback')
     # chargeback_refund list ids
-    list_chargeback_refund = df_p[df_p['status'] == 'chargeback_refund']['transaction_id'].unique()
+    list_chargeback_refund = engine.ids_with_status('chargeback_refund')
+    # credit list ids
+    list_credit = engine.ids_with_status('credit')
     # First problem: id within chargeback refund but not within chargeback
-    invalid_chargeback_refund_no_chargeback = [v for v in list_chargeback_refund if v not in list_chargeback]
+    invalid_chargeback_refund_no_chargeback = list_chargeback_refund[~list_chargeback_refund.isin(list_chargeback)]
     # chargeback ids that have counterpart within credit
-    list_chargeback_credit = [v for v in df_p[df_p['status'] == 'credit']['transaction_id'].unique()
-                              if v in list_chargeback and v not in list_chargeback_refund]
+    list_chargeback_credit = list_credit[list_credit.isin(list_chargeback) & ~list_credit.isin(list_chargeback_refund)]
     # Second problem: id within chargeback but no counterpart within chargeback_refund nor credit
-    invalid_chargeback_no_counterpart = [v for v in list_chargeback if v not in list_chargeback_refund.tolist() +
-                                         list_chargeback_credit]
+    invalid_chargeback_no_counterpart = list_chargeback[~list_chargeback.isin(list_chargeback_refund) &
+                                                        ~list_chargeback.isin(list_chargeback_credit)]
     # Check count identity :: chargeback - chargeback_refund - chargeback_credit (taking problems apart)
     invalid_chargeback_amount_check = (len(list_chargeback) - len(invalid_chargeback_no_counterpart)) - \
                                       (len(list_chargeback_refund) - len(invalid_chargeback_refund_no_chargeback)) - \
                                       len(list_chargeback_credit)
-    # 3rd Problem: sum from sales comparing to payables not matching
-    list_chargeback_ok = list(set(list_chargeback) - set(invalid_chargeback_refund_no_chargeback) -
-                              set(invalid_chargeback_no_counterpart))
-    df_s['valor'] = df_s['valor'].astype(float)
-    df_s['refund'] = df_s['refund'].astype(float)
-    df_s_group = df_s[df_s['transaction_id'].isin(list_chargeback_ok)].groupby('transaction_id')
-    df_p_group = df_p[df_p['transaction_id'].isin(list_chargeback_ok)].groupby('transaction_id')
-    invalid_chargeback_sum_error = df_s_group.sum().index[(df_s_group['valor'].sum() + df_s_group['refund'].sum() -
-                                                           df_p_group['valor'].sum()).abs() > .1].tolist()
-    return invalid_chargeback_refund_no_chargeback, invalid_chargeback_no_counterpart, invalid_chargeback_amount_check, \
-           invalid_chargeback_sum_error
+    # 3rd Problem: sum from sales comparing to payables not matching (ids without sales are not compared)
+    list_chargeback_ok = list_chargeback[~list_chargeback.isin(invalid_chargeback_no_counterpart)].sort_values()
+    chargeback_delta_sum = engine.s_sum.reindex(list_chargeback_ok) - engine.p_sum.reindex(list_chargeback_ok)
+    invalid_chargeback_sum_error = list_chargeback_ok[nonzero_cents(chargeback_delta_sum)].tolist()
+    return invalid_chargeback_refund_no_chargeback.tolist(), invalid_chargeback_no_counterpart.tolist(), \
+           invalid_chargeback_amount_check, invalid_chargeback_sum_error
+
+
+def rule_payables_refund_reversal(engine):
+    list_refund_reversal = engine.ids_with_status('refund_reversal')
+    # Ids without rows on one side sum 0
+    refund_reversal_delta_sum = engine.p_sum.reindex(list_refund_reversal, fill_value=0) - \
+                                engine.s_sum.reindex(list_refund_reversal, fill_value=0)
+    invalid_refund_reversal_sum = list_refund_reversal[nonzero_cents(refund_reversal_delta_sum)].tolist()
+    return invalid_refund_reversal_sum
+
+
+RECONCILIATION_RULES = {
+    'single_occurancy': rule_single_occurancy,
+    'refund': rule_refund,
+    'chargeback': rule_chargeback,
+    'payables_refund_reversal': rule_payables_refund_reversal,
+}
+
+
+def check_single_occurancy(df_p, df_t, df_s):
+    return ReconciliationEngine(df_p, df_t, df_s).evaluate('single_occurancy')
+
+
+def check_refund(df_p, df_s):
+    return ReconciliationEngine(df_p, df_s=df_s).evaluate('refund')
+
+
+def check_chargeback(df_p, df_s):
+    return ReconciliationEngine(df_p, df_s=df_s).evaluate('chargeback')
 
 
 def check_payables_refund_reversal(df_p, df_s):
-    list_refund_reversal = df_p[df_p['status'] == 'refund_reversal']['transaction_id'].unique()
-    invalid_refund_reversal_sum = []
-    for refund_id in list_refund_reversal:
-        p_sum = df_p[df_p['transaction_id'] == refund_id]['valor'].sum()
-        s_sum = df_s[df_s['transaction_id'] == refund_id]['valor'].sum() + df_s[df_s['transaction_id'] == refund_id]['refund'].sum()
-        if p_sum != s_sum:
-            invalid_refund_reversal_sum.append(refund_id)
-    return invalid_refund_reversal_sum
+    return ReconciliationEngine(df_p, df_s=df_s).evaluate('payables_refund_reversal')
 
 
+@instrumented()
 def check_sum_by_month(df):
-    df['data_caixa'] = pd.to_datetime(df['recebimento_financiamento'])
-    df['Parcela'] = df['gateway_id'].str.split("-").str[0]
-    df['Id da transação'] = df['gateway_id'].str.split("-").str[1]
-    df['Parcela'].replace(r'\b0\b', '1', regex=True, inplace=True)
+    df['data_caixa'] = to_date(df['recebimento_financiamento'])
+    df['Parcela'], df['Id da transação'] = split_gateway_id(df['gateway_id'])
+    df['Parcela'] = df['Parcela'].replace(0, 1)
     df = df[df['data_caixa'] > pd.to_datetime('2023-01-01')]
-    df['Parcela'] = df['Parcela'].astype(str)
-    df['Id da transação'] = df['Id da transação'].astype(str)
 
     extrato_diario = True
     if extrato_diario:
         df_extrato = local_df_load_extrato_diario()
         df_extrato['data_caixa'] = pd.to_datetime(df_extrato['Data de pagamento'], format='%d/%m/%Y %H:%M')
-        df_extrato['Id da transação'] = df_extrato['ID da Transação'].astype(str)
-        df_extrato['Parcela'].replace({'-': '1'}, inplace=True)
-        df_extrato['Parcela'] = df_extrato['Parcela'].astype(str)
+        df_extrato['Id da transação'] = to_id(df_extrato['ID da Transação'])
+        df_extrato['Parcela'] = to_installment(df_extrato['Parcela'].replace({'-': '1'}))
     else:
         df_extrato = pd.read_excel('pagarme_extrato.xlsx', engine='openpyxl')
         df_extrato['data_caixa'] = pd.to_datetime(df_extrato['Data da operação'], format='%d/%m/%Y %H:%M')
-        df_extrato['Id da transação'] = df_extrato['Id da transação'].astype(str)
-        df_extrato['Parcela'].replace({'-': '1'}, inplace=True)
-        df_extrato['Parcela'] = df_extrato['Parcela'].astype(str)
+        df_extrato['Id da transação'] = to_id(df_extrato['Id da transação'])
+        df_extrato['Parcela'] = to_installment(df_extrato['Parcela'].replace({'-': '1'}))
         df_extrato['Tipo da operação'] = df_extrato['Tipo da operação'].astype(str)
 
     df_transactions = pd.read_feather("faturamento_pagarme_transactions.feather")
-    df_transactions = df_transactions[['transaction_id', 'nsu']]
-    df_transactions['transaction_id'] = df_transactions['transaction_id'].astype(str)
-    df_transactions['nsu'] = df_transactions['nsu'].astype(str)
-    df_transactions['nsu'] = df_transactions['nsu'].str.split(".").str[0]
+    df_transactions = pd.DataFrame({'transaction_id': to_id(df_transactions['transaction_id']),
+                                    'nsu': to_id(df_transactions['nsu'])})
 
     df_extrato = df_extrato.merge(df_transactions, left_on=['Id da transação'], right_on=['nsu'], how='left')
 
@@ -247,48 +614,6 @@ def check_according_spreadsheet(df):
 
 if __name__ == '__main__':
 
-    if load_from_DB:
-        df_pagarme_payables, df_pagarme_transactions, df_pagarme_sales = db_bulk_load()
-        # Eliminate problem columns
-        df_pagarme_transactions.pop('pagarme_transactions_created_at')
-        df_pagarme_transactions.pop('pagarme_transactions_updated_at')
-        # Save new data locally
-        local_df_save({'pagarme_payables': df_pagarme_payables, 'pagarme_transactions': df_pagarme_transactions,
-                       'pagarme_sales': df_pagarme_sales})
-    else:
-        # Dataframe local data load
-        [df_pagarme_payables, df_pagarme_transactions, df_pagarme_sales] = \
-            local_df_load(["pagarme_payables", 'pagarme_transactions', 'pagarme_sales'])
-
-    # Check with extrato
-    check_sum_by_month(df_pagarme_sales)
-
-    # Adjust Payables DB
-    df_pagarme_payables = payables_adjust(df_pagarme_payables)
-    # Adjust Sales DB
-    df_pagarme_sales = sales_adjust(df_pagarme_sales)
-
-    # Get Status Types and Ocurrancies within transactions ad payables DB
-    status_transactions = df_pagarme_transactions['status'].value_counts()
-    status_payables = df_pagarme_payables['status'].value_counts()
-
-    # Check single occurrences within payables
-    invalid_unique_st_status, invalid_unique_st_installments, invalid_unique_st_s_refund,  \
-    invalid_unique_st_missing_s, invalid_unique_st_valuesDiff = \
-        check_single_occurancy(df_pagarme_payables, df_pagarme_transactions, df_pagarme_sales)
-
-    # Check pair credit | refund discrepancies
-    invalid_refund_only_no_sales, invalid_refund_only_sum_error = check_refund(df_pagarme_payables, df_pagarme_sales)
-
-    # Check chargeback payables discrepancies
-    invalid_chargeback_refund_no_chargeback, invalid_chargeback_no_counterpart, invalid_chargeback_amount_check, \
-    invalid_chargeback_sum_error = check_chargeback(df_pagarme_payables, df_pagarme_sales)
-
-    # Check refund reversal discrepancies between sales and payables
-    invalid_refund_reversal_sum = check_payables_refund_reversal(df_pagarme_payables, df_pagarme_sales)
-
-    # Get complete transactions
-    invalid_unique_st_missing_s_transactions = df_pagarme_transactions[df_pagarme_transactions['transaction_id'].
-    isin(invalid_unique_st_missing_s)]
-
-    pass
+    # Former entry point: refresh the feather cache from the DB and run every payables check
+    from financial_check import main
+    main(['check', '--refresh', '--sum-by-month'])
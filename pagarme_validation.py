@@ -3,28 +3,33 @@ import numpy as np
 import os
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from mysql.connector import connect, Error
-from sqlalchemy import create_engine, text
+
+from database import db_engine
+from extrato import extrato_cache_refresh, load_extrato_diario, load_extrato_diario_range, parse_brl
+from instrumentation import instrumented
+from money import to_cents
+from schema import split_gateway_id, to_date, to_id, to_installment
 
 load_dotenv()
 
+# Cash date placeholder for extrato rows without that movement (credit-only rows have no refund date and back)
+EXTRATO_NO_DATE = pd.to_datetime('1987-12-17')
+# Amount columns compared between sales and extrato in the monthly report
+REPORT_AMOUNTS = ['venda', 'venda_taxa', 'refund', 'reembolso_taxa']
+
 
 def db_load(query):
+    from mysql.connector import Error
     try:
-        # create sqlalchemy engine
-        engine = create_engine("mysql+pymysql://{user}:{pw}@{ep}:{port}/{db}"
-                               .format(user=os.environ.get("DATABASE_USER"),
-                                       pw=os.environ.get("DATABASE_PASS"),
-                                       ep=os.environ.get("DATABASE_HOST"),
-                                       port=os.environ.get("DATABASE_PORT"),
-                                       db=os.environ.get("DATABASE_NAME")))
-        df_retrieved = pd.read_sql(query, engine)
+        df_retrieved = pd.read_sql(query, db_engine())
         return df_retrieved
     except Error as err:
         return -1, err
 
 
+@instrumented()
 def db_sales_load():
     if os.environ.get("DATABASE_NAME") == 'dnc_sales':
         sales = db_load("SELECT * from pagarme_sales_corrigido WHERE gateway_name = 'Pagarme'")
@@ -33,11 +38,13 @@ def db_sales_load():
     return sales
 
 
+@instrumented()
 def local_df_save(dict2save):
     for file_name, df_name in dict2save.items():
         df_name.to_feather(os.environ.get("DATABASE_NAME") + "_" + file_name + ".feather")
 
 
+@instrumented()
 def local_df_load(files2load):
     df_loaded = []
     for file_name in files2load:
@@ -47,71 +54,56 @@ def local_df_load(files2load):
 
 
 def local_df_load_extrato_diario():
-    import os
-    import pandas as pd
-
-    # Directory containing the Excel files
-    folder_path = './extrato_diario'
-    # List to store DataFrames
-    dfs = []
-    # Iterate through each subfolder
-    for subdir, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith('.csv'):
-                file_path = os.path.join(subdir, file)
-                df = pd.read_csv(file_path)
-                # Make all column names lowercase
-                df.columns = df.columns.str.lower()
-                dfs.append(df)
-    # Concatenate DataFrames vertically
-    combined_df = pd.concat(dfs, ignore_index=True)
-    return combined_df
-
-
-def adjust_sales(df_sales):
-    # select only data between desired time
+    return load_extrato_diario()
+
+
+@instrumented()
+def adjust_sales(df_sales, start='2023-01-01', end='2024-01-01'):
+    # select only data between desired time (None leaves that side open)
     df_sales['venda_caixa'] = pd.to_datetime(df_sales['recebimento_financiamento']).dt.normalize()
     df_sales['refund_caixa'] = pd.to_datetime(df_sales['efetivacao_cancelamento']).dt.normalize()
-    df_sales = df_sales[(df_sales['venda_caixa'] >= pd.to_datetime('2023-01-01')) &
-                        (df_sales['venda_caixa'] < pd.to_datetime('2024-01-01'))]
-    # create id and installment from gateway_id
-    df_sales['parcela'] = df_sales['gateway_id'].str.split("-").str[0]
-    df_sales['parcela'].replace(r'\b0\b', '1', regex=True, inplace=True)
-    df_sales['transaction_id'] = df_sales['gateway_id'].str.split("-").str[1]
+    if start is not None:
+        df_sales = df_sales[df_sales['venda_caixa'] >= pd.to_datetime(start)]
+    if end is not None:
+        df_sales = df_sales[df_sales['venda_caixa'] < pd.to_datetime(end)]
+    # create id and installment from gateway_id (installment 0 counts as 1)
+    df_sales['parcela'], df_sales['transaction_id'] = split_gateway_id(df_sales['gateway_id'])
+    df_sales['parcela'] = df_sales['parcela'].replace(0, 1)
+    df_sales['data_venda'] = to_date(df_sales['data_venda'])
     # define types
-    df_sales[['parcela', 'transaction_id']] = df_sales[['parcela', 'transaction_id']].astype(str)
-    df_sales.fillna('0', inplace=True)
+    df_sales = df_sales.fillna({'valor_total_venda': 0, 'valor_taxa_total': 0, 'valor_cancelamento': 0,
+                                'reembolso_taxa': 0})
+    # amounts as integer cents
     df_sales[['venda', 'venda_taxa', 'refund', 'reembolso_taxa']] = \
-        df_sales[['valor_total_venda', 'valor_taxa_total', 'valor_cancelamento', 'reembolso_taxa']].astype(float)
+        df_sales[['valor_total_venda', 'valor_taxa_total', 'valor_cancelamento', 'reembolso_taxa']].apply(to_cents)
     # restrict columns to analyze
     colums_to_keep = ['gateway_id', 'data_venda', 'venda', 'venda_taxa', 'refund',
                       'reembolso_taxa', 'transaction_id', 'parcela', 'venda_caixa', 'refund_caixa']
     return df_sales[colums_to_keep]
 
 
-def adjust_extrato():
-    df_extrato = local_df_load_extrato_diario()
+@instrumented()
+def adjust_extrato(df_extrato=None):
+    # Statement lines as loaded by load_extrato_diario (all of them when not given)
+    if df_extrato is None:
+        df_extrato = local_df_load_extrato_diario()
     df_extrato['venda_caixa'] = pd.to_datetime(df_extrato['data de pagamento'], format='%d/%m/%Y %H:%M').dt.normalize()
     df_extrato.rename(columns={'id da transação': 'nsu', 'parcela': 'parcela', 'data de criação': 'data_venda'},
                       inplace=True)
     # adjust types
-    df_extrato['parcela'].replace({'-': '1'}, inplace=True)
-    df_extrato[['nsu', 'parcela']] = df_extrato[['nsu', 'parcela']].astype(str)
-    # Create comparable columns to sales
-    df_extrato.replace({'-': '0'}, inplace=True)
-    df_extrato['nsu'] = df_extrato['nsu'].astype(str)
-    df_extrato['nsu'] = df_extrato['nsu'].str.split(".").str[0]
-    df_extrato = df_extrato.applymap(lambda x: x.replace('.', '') if isinstance(x, str) else x)
-    df_extrato = df_extrato.applymap(lambda x: x.replace(',', '.') if isinstance(x, str) else x)
-    df_extrato['venda'] = df_extrato['entrada'].astype(float)
-    df_extrato['refund'] = df_extrato['saída'].astype(float)
-    df_extrato['taxa total da operação'] = df_extrato['taxa total da operação'].astype(float)
-    df_extrato['venda_taxa'] = np.where(df_extrato['venda'] > 0, df_extrato['taxa total da operação'], 0)
-    df_extrato['reembolso_taxa'] = np.where(df_extrato['refund'] < 0, df_extrato['taxa total da operação'], 0)
+    df_extrato['parcela'] = to_installment(df_extrato['parcela'].replace({'-': '1'}))
+    df_extrato['nsu'] = to_id(df_extrato['nsu'])
+    # Create comparable columns to sales: only the monetary columns are parsed from pt-BR format, as integer
+    # cents (empty cells carry no amount)
+    df_extrato['venda'] = to_cents(parse_brl(df_extrato['entrada'])).fillna(0)
+    df_extrato['refund'] = to_cents(parse_brl(df_extrato['saída'])).fillna(0)
+    df_extrato['taxa total da operação'] = to_cents(parse_brl(df_extrato['taxa total da operação'])).fillna(0)
+    df_extrato['venda_taxa'] = df_extrato['taxa total da operação'].where(df_extrato['venda'] > 0, 0)
+    df_extrato['reembolso_taxa'] = df_extrato['taxa total da operação'].where(df_extrato['refund'] < 0, 0)
     # Create venda_caixa for venda and refund
     df_extrato['refund_caixa'] = df_extrato['venda_caixa']
-    df_extrato.loc[df_extrato['venda'] > 0, 'refund_caixa'] = pd.to_datetime('1987-12-17')  # no value
-    df_extrato.loc[df_extrato['refund'] < 0, 'venda_caixa'] = pd.to_datetime('1987-12-17')  # no value
+    df_extrato.loc[df_extrato['venda'] > 0, 'refund_caixa'] = EXTRATO_NO_DATE  # no value
+    df_extrato.loc[df_extrato['refund'] < 0, 'venda_caixa'] = EXTRATO_NO_DATE  # no value
     # restrict columns to analyze
     colums_to_keep = ['data_venda', 'venda', 'venda_taxa', 'refund',
                       'reembolso_taxa', 'nsu', 'parcela', 'venda_caixa', 'refund_caixa']
@@ -124,15 +116,26 @@ def adjust_extrato():
     return df_extrato[colums_to_keep]
 
 
-def adjust_transactions():
-    df_transactions = pd.read_feather("faturamento_pagarme_transactions.feather")
-    df_transactions = df_transactions[['transaction_id', 'nsu']]
-    df_transactions['transaction_id'] = df_transactions['transaction_id'].astype(str)
-    df_transactions['nsu'] = df_transactions['nsu'].astype(str)
-    df_transactions['nsu'] = df_transactions['nsu'].str.split(".").str[0]
-    return df_transactions
+@instrumented()
+def adjust_transactions(nsu=None):
+    # nsu -> transaction_id of the transactions, or only of the given nsus: the two columns are then read and
+    # filtered batch by batch
+    if nsu is None:
+        df_transactions = pd.read_feather("faturamento_pagarme_transactions.feather", columns=['transaction_id', 'nsu'])
+        return pd.DataFrame({'transaction_id': to_id(df_transactions['transaction_id']),
+                             'nsu': to_id(df_transactions['nsu'])})
+    import pyarrow.dataset as ds
+    nsu = pd.Index(nsu.dropna().unique())
+    frames = [pd.DataFrame({'transaction_id': pd.Series(dtype='Int64'), 'nsu': pd.Series(dtype='Int64')})]
+    for batch in ds.dataset("faturamento_pagarme_transactions.feather", format='ipc').\
+            to_batches(columns=['transaction_id', 'nsu']):
+        df_batch = pd.DataFrame({'transaction_id': to_id(batch.column('transaction_id').to_pandas()),
+                                 'nsu': to_id(batch.column('nsu').to_pandas())})
+        frames.append(df_batch[df_batch['nsu'].isin(nsu)])
+    return pd.concat(frames, ignore_index=True)
 
 
+@instrumented()
 def extrato_check(df_sales):
 
     df_sales = adjust_sales(df_sales)
@@ -146,22 +149,130 @@ def extrato_check(df_sales):
 
     df_jan = df_compare[(df_compare['venda_caixa_sales'] >= pd.to_datetime('2023-01-01')) &
                         (df_compare['venda_caixa_sales'] < pd.to_datetime('2023-02-01'))]
-    df_jan.loc[df_jan['refund_caixa_extrato'] == pd.to_datetime('1987-12-17'), 'refund_caixa_extrato'] = 0
+    df_jan.loc[df_jan['refund_caixa_extrato'] == EXTRATO_NO_DATE, 'refund_caixa_extrato'] = 0
 
     pass
 
 
-if __name__ == '__main__':
+def cash_window(month, start=None, end=None):
+    # Cash dates [begin, end) of a month, cut to the checked range
+    begin, month_end = month.start_time, (month + 1).start_time
+    if start is not None:
+        begin = max(begin, pd.Timestamp(start))
+    if end is not None:
+        month_end = min(month_end, pd.Timestamp(end))
+    return begin, month_end
+
 
-    load_from_DB = True
+def in_window(dates, begin, end):
+    dates = pd.to_datetime(dates)
+    return ((dates >= begin) & (dates < end)).to_numpy(bool)
 
-    if load_from_DB:
-        df_sales = db_sales_load()
-        # Save new data locally
-        local_df_save({'pagarme_sales': df_sales})
+
+def cash_months(dates, start, end):
+    # Month (YYYY-MM) of every date in [start, end), NaN for the others
+    dates = pd.to_datetime(dates)
+    return dates.dt.strftime('%Y-%m').where(in_window(dates, pd.Timestamp(start), pd.Timestamp(end)))
+
+
+def sales_months_split(source, start, end, split_path):
+    # One pass over the sales cache, feather file batch by batch or parquet store partition by partition, writing
+    # every row to the cash months in [start, end) it was received or refunded in (see spill_save), so each month
+    # worker reads only its own rows
+    import pyarrow.dataset as ds
+    from pagarme_check import SALES_COLUMNS, local_df_path, local_store_path, spill_save
+    if source == 'parquet':
+        store_path = local_store_path('pagarme_sales')
+        pieces = (pd.read_parquet(os.path.join(store_path, partition, 'data.parquet'), columns=SALES_COLUMNS)
+                  for partition in sorted(os.listdir(store_path)))
     else:
-        # Dataframe local data load
-        df_sales = local_df_load(['pagarme_sales'])
+        pieces = (batch.to_pandas() for batch in
+                  ds.dataset(local_df_path('pagarme_sales'), format='ipc').to_batches(columns=SALES_COLUMNS))
+    for i, df_piece in enumerate(pieces):
+        received = cash_months(df_piece['recebimento_financiamento'], start, end)
+        refunded = cash_months(df_piece['efetivacao_cancelamento'], start, end)
+        spill_save(split_path, df_piece[received.notna()], received.dropna(), 2 * i)
+        # Rows refunded in another month than they were received in are in both months
+        refunded_apart = refunded.notna() & (refunded != received)
+        spill_save(split_path, df_piece[refunded_apart], refunded[refunded_apart], 2 * i + 1)
+
+
+def sales_month_load(month, split_path):
+    # Sales rows received or refunded in a cash month, as written by sales_months_split
+    from pagarme_check import SALES_COLUMNS, spill_load
+    partition = 'month=' + month.strftime('%Y-%m')
+    if not os.path.exists(os.path.join(split_path, partition)):
+        return pd.DataFrame(columns=SALES_COLUMNS)
+    return spill_load(split_path, partition)
+
+
+def sales_movements(df_sales, begin, end):
+    # Cash basis: credit amounts of the rows received in [begin, end) and refund amounts of the rows refunded in it
+    received = in_window(df_sales['venda_caixa'], begin, end)
+    refunded = in_window(df_sales['refund_caixa'], begin, end)
+    df_sales = df_sales.copy()
+    df_sales.loc[~received, ['venda', 'venda_taxa']] = 0
+    df_sales.loc[~refunded, ['refund', 'reembolso_taxa']] = 0
+    return df_sales[received | refunded]
+
+
+def extrato_month_worker(month, split_path, start, end):
+    # Loads, adjusts and reconciles the sales and statement lines of one cash month only, with the transactions of
+    # the month nsus
+    begin, month_end = cash_window(month, start, end)
+    df_sales = sales_movements(adjust_sales(sales_month_load(month, split_path), None, None), begin, month_end)
+    df_extrato = adjust_extrato(load_extrato_diario_range(begin, month_end))
+    df_extrato = df_extrato.merge(adjust_transactions(df_extrato['nsu']), on=['nsu'], how='left')
+    return extrato_month_check(month, df_sales, df_extrato)
+
+
+def extrato_month_check(month, df_sales, df_extrato):
+    # Reconciliation of one cash month: matched rows, rows missing on either side and sales - extrato deltas
+    keys = ['transaction_id', 'parcela']
+    df_compare = df_sales.merge(df_extrato, on=keys, suffixes=('_sales', '_extrato'), how='left', indicator=True)
+    extrato_in_sales = df_extrato[keys].merge(df_sales[keys].drop_duplicates(), on=keys, how='left', indicator=True)
+    matched = df_compare[df_compare['_merge'] == 'both']
+    report = {'month': str(month), 'sales_rows': len(df_sales), 'extrato_rows': len(df_extrato),
+              'matched': len(matched),
+              'missing_in_extrato': int((df_compare['_merge'] == 'left_only').sum()),
+              'missing_in_sales': int((extrato_in_sales['_merge'] == 'left_only').sum())}
+    differs = np.zeros(len(matched), dtype=bool)
+    for column in REPORT_AMOUNTS:
+        delta = matched[column + '_sales'] - matched[column + '_extrato']
+        differs |= delta.fillna(0).ne(0).to_numpy(bool)
+        report[column + '_delta'] = int(delta.sum())
+        report[column + '_sales'] = int(df_sales[column].sum())
+        report[column + '_extrato'] = int(df_extrato[column].sum())
+    report['value_mismatches'] = int(differs.sum())
+    return report
+
+
+@instrumented()
+def extrato_check_by_month(source='feather', start='2023-01-01', end='2024-01-01', max_workers=None):
+    # Cash basis reconciliation of [start, end): credits are checked in the month they were received and refunds
+    # in the month they were refunded. The sales cache given by source (feather file or parquet store) is split by
+    # month once, then every month is loaded, adjusted and reconciled in its own worker process and only the
+    # report rows come back
+    import shutil
+    extrato_cache_refresh()
+    split_path = os.environ.get("DATABASE_NAME") + "_pagarme_sales_months"
+    shutil.rmtree(split_path, ignore_errors=True)
+    sales_months_split(source, start, end, split_path)
+    months = [month for month in pd.period_range(start, end, freq='M') if month.start_time < pd.Timestamp(end)]
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            futures = [executor.submit(extrato_month_worker, month, split_path, start, end) for month in months]
+            report = pd.DataFrame([future.result() for future in futures])
+    finally:
+        shutil.rmtree(split_path, ignore_errors=True)
+    if report.empty:
+        return report
+    total = report.drop(columns='month').sum()
+    return pd.concat([report, pd.DataFrame([{'month': 'total', **total.to_dict()}])], ignore_index=True)
+
+
+if __name__ == '__main__':
 
-    # Check with extrato
-    extrato_check(df_sales)
+    # Former entry point: refresh the cached sales from the DB and reconcile them with extrato by month
+    from financial_check import main
+    main(['extrato', '--refresh', '--by-month'])
@@ -0,0 +1,27 @@
+import pandas as pd
+
+# Canonical compact schema shared by all tables, applied once per table right after loading: ids as int64,
+# installments as int16, statuses as categoricals and dates as datetime64. Merges and groupbys key on these.
+
+
+def to_id(values):
+    # transaction_id / nsu (ints, floats like 123.0 or numeric strings) as nullable int64
+    return pd.to_numeric(values, errors='coerce').astype('Int64')
+
+
+def to_installment(values):
+    return pd.to_numeric(values, errors='coerce').astype('Int16')
+
+
+def to_status(values):
+    return values.astype('category')
+
+
+def to_date(values):
+    return pd.to_datetime(values, errors='coerce')
+
+
+def split_gateway_id(gateway_id):
+    # gateway_id is "<installment>-<transaction_id>": split once into both typed keys
+    parts = gateway_id.str.split('-')
+    return to_installment(parts.str[0]), to_id(parts.str[1])